@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Micro-benchmark of making elements in the docx composer.
+
+    Compare elements per second of building fixed subtrees from tree lists
+    without the name caches (as before), from tree lists with the name
+    caches, and by cloning the prototypes.
+
+    usage: python contrib/bench_element_tree.py [iterations]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'sphinx-docxbuilder'))
+from docx import docx
+
+
+def paragraph_tree():
+    return [['w:p'],
+            [['w:pPr'],
+             [['w:pStyle', {'w:val': ''}]],
+             [['w:ind', {'w:leftChars': '0', 'w:left': ''}]]]]
+
+def table_row_tree():
+    return [['w:tr'], [['w:trPr'], [['w:cnfStyle', {'w:val': ''}]]],
+            [['w:tc'], [['w:tcPr'], [['w:cnfStyle', {'w:val': ''}]]]],
+            [['w:tc'], [['w:tcPr'], [['w:cnfStyle', {'w:val': ''}]]]]]
+
+def picture_tree():
+    pic_tree = [['pic:pic'],
+                [['pic:nvPicPr'],
+                 [['pic:cNvPr', {'id': '0', 'name': 'Picture 1', 'descr': ''}]],
+                 [['pic:cNvPicPr'], [['a:picLocks', {'noChangeAspect': '1',
+                                                     'noChangeArrowheads': '1'}]]]],
+                [['pic:blipFill'],
+                 [['a:blip', {'r:embed': ''}]],
+                 [['a:srcRect']],
+                 [['a:stretch'], [['a:fillRect']]]],
+                [['pic:spPr', {'bwMode': 'auto'}],
+                 [['a:xfrm'], [['a:off', {'x': '0', 'y': '0'}]], [['a:ext', {'cx': '', 'cy': ''}]]],
+                 [['a:prstGeom', {'prst': 'rect'}], ['a:avLst']],
+                 [['a:noFill']]]]
+    graphic_tree = [['a:graphic'],
+                    [['a:graphicData', {'uri': 'http://schemas.openxmlformats.org/drawingml/2006/picture'}],
+                     pic_tree]]
+    inline_tree = [['wp:inline', {'distT': '0', 'distB': '0', 'distL': '0', 'distR': '0'}],
+                   [['wp:extent', {'cx': '', 'cy': ''}]],
+                   [['wp:effectExtent', {'l': '25400', 't': '0', 'r': '0', 'b': '0'}]],
+                   [['wp:docPr', {'id': '2', 'name': 'Picture 1', 'descr': ''}]],
+                   [['wp:cNvGraphicFramePr'], [['a:graphicFrameLocks', {'noChangeAspect': '1'}]]],
+                   graphic_tree]
+    return [['w:p'],
+            [['w:pPr'], [['w:jc', {'w:val': 'center'}]]],
+            [['w:r'], [['w:rPr'], [['w:noProof']]], [['w:drawing'], inline_tree]]]
+
+def clear_caches():
+    docx._qnames.clear()
+    docx._nsmaps.clear()
+    docx._prototypes.clear()
+
+def run(name, func, make_tree, iterations):
+    nelems = len(list(docx.make_element_tree(make_tree()).iter()))
+    start = time.time()
+    for i in xrange(iterations):
+        func(name, make_tree)
+    elapsed = time.time() - start
+    return nelems * iterations / elapsed
+
+def uncached(name, make_tree):
+    clear_caches()
+    return docx.make_element_tree(make_tree())
+
+def interned(name, make_tree):
+    return docx.make_element_tree(make_tree())
+
+def cloned(name, make_tree):
+    return docx.get_prototype(name, make_tree)
+
+def main():
+    iterations = 20000
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+
+    print '%-12s %14s %14s %14s' % ('subtree', 'uncached', 'interned', 'prototype')
+    for name, make_tree in (('paragraph', paragraph_tree),
+                            ('table row', table_row_tree),
+                            ('picture', picture_tree)):
+        rates = [run(name, func, make_tree, iterations)
+                 for func in (uncached, interned, cloned)]
+        clear_caches()
+        print '%-12s %14.0f %14.0f %14.0f  elements/s (x%.1f)' % (
+                name, rates[0], rates[1], rates[2], rates[2] / rates[0])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Check the tokens and the runs made by the highlighter of the docx builder.
+
+    Tokens of streamed literal blocks must have the same text as the
+    tokens of the whole block, even if the lexer strips newlines or
+    converts CRLF. With a style file which already has a token style name (e.g.
+    'Pygments Keyword') under another style id, runs must refer the
+    style id of the template, and every referred style must exist.
+
+    usage: python contrib/check_highlight.py
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import zipfile
+
+from lxml import etree
+
+package_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           '..', 'sphinx-docxbuilder')
+sys.path.insert(0, package_dir)
+from docx import docx
+from highlight import DocxPygmentsBridge, rstyle_path, w_tag
+
+style_file = os.path.join(package_dir, 'docx', 'style.docx')
+
+template_style = ('<w:style xmlns:w="%s" w:type="character" w:styleId="TemplateKeyword">'
+                  '<w:name w:val="Pygments Keyword"/><w:rPr><w:b/></w:rPr></w:style>'
+                  % docx.nsprefixes['w'])
+
+def make_template(dirname):
+    '''
+       Copy the style file with a character style named 'Pygments Keyword'
+    '''
+    filename = os.path.join(dirname, 'template.docx')
+    src = zipfile.ZipFile(style_file)
+    dst = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED)
+    for zinfo in src.infolist():
+        data = src.read(zinfo)
+        if zinfo.filename == 'word/styles.xml':
+            styles = etree.fromstring(data)
+            styles.append(etree.fromstring(template_style))
+            data = etree.tostring(styles, xml_declaration=True, encoding='UTF-8',
+                                  standalone='yes')
+        dst.writestr(zinfo, data)
+    dst.close()
+    src.close()
+    return filename
+
+def check(name, ok):
+    print '%-4s %s' % (ok and 'ok' or 'FAIL', name)
+    return not ok
+
+# (description, source, language, max_lines, text of the streamed tokens)
+streamed_cases = [
+    ('leading blank lines', u'\n\nx = 1\ny = 2', 'ruby', 0, None),
+    ('CRLF', u'a = 1\r\nb = 2\r\n', 'python', 0, None),
+    ('CR', u'a = 1\rb = 2', 'python', 0, None),
+    ('tabs', u'if x:\n\ty = 1\n', 'python', 0, None),
+    ('no newline at the end', u'x = 1', 'python', 0, None),
+    ('max_lines with CRLF', u'a = 1\r\nb = 2\r\nc = 3\r\n', 'python', 1,
+     u'a = 1\nb = 2\nc = 3\n'),
+    ('max_lines with blank lines', u'\n\na = 1\nb = 2\n', 'ruby', 1, u'a = 1\nb = 2\n'),
+]
+
+def check_streamed_tokens():
+    failed = 0
+    highlighter = DocxPygmentsBridge('html', 'sphinx')
+    for desc, source, lang, max_lines, expected in streamed_cases:
+        if expected is None:
+            expected = u''.join(v for t, v in highlighter.get_tokens(source, lang))
+        text = u''.join(v for t, v in highlighter.iter_tokens(source, lang,
+                                                              max_lines=max_lines))
+        failed += check('streamed tokens: %s' % desc, text == expected)
+    return failed
+
+def check_template_token_style():
+    failed = 0
+    dirname = tempfile.mkdtemp()
+    try:
+        composer = docx.DocxComposer()
+        composer.new_document(make_template(dirname))
+        highlighter = DocxPygmentsBridge('html', 'sphinx', token_styles=True)
+        highlighter.add_token_styles(composer)
+        runs = highlighter.highlight_runs(u'def f(x):\n    return x\n', 'python')
+
+        style_ids = set(x.get(w_tag('styleId')) for x in composer.styleDocx.styles)
+        referred = [x.find(rstyle_path).get(w_tag('val')) for x in runs
+                    if x.find(rstyle_path) is not None]
+        failed += check('runs refer token styles', referred)
+        failed += check('referred styles exist in styles.xml',
+                        set(referred) <= style_ids)
+        failed += check('keywords refer the style of the template',
+                        'TemplateKeyword' in referred)
+        failed += check('savings are counted for the style of the template',
+                        sum(highlighter.get_saved_bytes(x) for x in runs) > 0)
+    finally:
+        shutil.rmtree(dirname)
+    return failed
+
+def main():
+    failed = check_streamed_tokens()
+    failed += check_template_token_style()
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Compare the 'lxml' and 'fast' XML backends of the docx composer.
+
+    The same paragraphs, headings, list items and tables are composed
+    with both backends, and the bodies of the documents must be the same
+    when they are serialized. Then the throughput of a body-heavy
+    document is measured for each backend.
+
+    usage: python contrib/compare_xml_backends.py [paragraphs]
+"""
+
+import os
+import sys
+import time
+
+from lxml import etree
+
+package_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           '..', 'sphinx-docxbuilder')
+sys.path.insert(0, package_dir)
+from docx import docx
+
+style_file = os.path.join(package_dir, 'docx', 'style.docx')
+
+# (description, paragraph text)
+cases = [
+    ('plain text', u'Plain text'),
+    ('empty text', u''),
+    ('no text', None),
+    ('empty list', []),
+    ('spaces', u'  leading and trailing  '),
+    ('markup characters', u'a < b && c > d "quoted" \'single\''),
+    ('carriage return', u'line\r\nbreak\rhere'),
+    ('tab and newline', u'tab\there\nnewline'),
+    ('non-ascii', u'café 日本語 αβ'),
+    ('styled runs', [u'Text with ', [u'emphasis', 'Emphasis'], u' and ',
+                     [u'strong text', 'Strong'], u'.']),
+    ('new character style', [[u'custom', 'Compare Custom Style']]),
+    ('line breaks', [u'first', ':br', u'second', [':br', 'Emphasis']]),
+    ('normal style in list', [[u'normal run', 'Normal']]),
+    ('byte string', 'ascii bytes & more'),
+]
+
+def compose(backend, breakbefore=False):
+    composer = docx.DocxComposer(style_file)
+    composer.xml_backend = backend
+    composer.breakbefore = breakbefore
+    for desc, text in cases:
+        composer.paragraph(text)
+        composer.paragraph(text, style='Compare Paragraph Style', block_level=2)
+        if text is not None:
+            composer.heading(text, 2)
+            composer.list_item(text)
+    composer.table([[u'a & b', u'c'], [[u'd', 'Strong'], u'e < f']])
+    body = etree.tostring(composer.docbody, encoding='UTF-8')
+    styles = etree.tostring(composer.styleDocx.styles, encoding='UTF-8')
+    return body, styles
+
+def compare():
+    failed = 0
+    for breakbefore in (False, True):
+        lxml_body, lxml_styles = compose('lxml', breakbefore)
+        fast_body, fast_styles = compose('fast', breakbefore)
+        for name, a, b in (('body', lxml_body, fast_body),
+                           ('styles', lxml_styles, fast_styles)):
+            if a == b:
+                print 'same %s (breakbefore=%s)' % (name, breakbefore)
+            else:
+                print 'DIFFERENT %s (breakbefore=%s)' % (name, breakbefore)
+                failed += 1
+    return failed
+
+def measure(backend, nparagraphs):
+    composer = docx.DocxComposer(style_file)
+    composer.xml_backend = backend
+    text = [u'Some body text with ', [u'emphasis', 'Emphasis'], u' and ',
+            [u'literal', 'Literal'], u' runs, which is typical of a paragraph.']
+    start = time.time()
+    for i in xrange(nparagraphs):
+        composer.paragraph(text)
+    elapsed = time.time() - start
+    size = len(etree.tostring(composer.docbody, encoding='UTF-8'))
+    return nparagraphs / elapsed, size
+
+def main():
+    nparagraphs = 20000
+    if len(sys.argv) > 1:
+        nparagraphs = int(sys.argv[1])
+
+    failed = compare()
+
+    rates = {}
+    for backend in ('lxml', 'fast'):
+        rates[backend], size = measure(backend, nparagraphs)
+        print '%-5s %10.0f paragraphs/s (%d bytes of body)' % (backend, rates[backend], size)
+    print 'fast / lxml: x%.1f' % (rates['fast'] / rates['lxml'])
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
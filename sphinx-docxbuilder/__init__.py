@@ -12,4 +12,25 @@ def setup(app):
     app.add_config_value('docx_descriptions', 'This document generaged by sphix-docxbuilder', 'env')
     app.add_config_value('docx_keywords', ['python', 'Office Open XML', 'Word'] , 'env')
     app.add_config_value('docx_coverpage', True, 'env')
+    app.add_config_value('docx_prepass_workers', None, 'env')
+    app.add_config_value('docx_prepass_executor', 'thread', 'env')
+    app.add_config_value('docx_source_report', None, 'env')
+    app.add_config_value('docx_cache_dir', None, 'env')
+    app.add_config_value('docx_highlight_cache_size', 64 * 1024 * 1024, 'env')
+    app.add_config_value('docx_highlight_token_styles', False, 'env')
+    app.add_config_value('docx_highlight_stream_size', 1024*1024, 'env')
+    app.add_config_value('docx_highlight_max_lines', 0, 'env')
+    app.add_config_value('docx_image_resample_dpi', None, 'env')
+    app.add_config_value('docx_image_quality', 85, 'env')
+    app.add_config_value('docx_image_convert', {'.bmp': '.png', '.tif': '.png', '.tiff': '.png'}, 'env')
+    app.add_config_value('docx_image_cache_size', 256*1024*1024, 'env')
+    app.add_config_value('docx_image_mode', 'embed', 'env')
+    app.add_config_value('docx_image_link_absolute', False, 'env')
+    app.add_config_value('docx_graphviz_timeout', 60, 'env')
+    app.add_config_value('docx_graphviz_workers', None, 'env')
+    app.add_config_value('docx_graphviz_cache_size', 64 * 1024 * 1024, 'env')
+    app.add_config_value('docx_math_cache_size', 16 * 1024 * 1024, 'env')
+    app.add_config_value('docx_xml_backend', 'lxml', 'env')
+    app.add_config_value('docx_compression', 'default', 'env')
+    app.add_config_value('docx_compression_threads', None, 'env')
 
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinx-docxbuilder attribution
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Attribute the translation time and the output size of the single
+    assembled document to its source documents.
+
+    :license: MIT, see LICENSE for details.
+"""
+
+import csv
+import time
+
+from lxml import etree
+
+#
+#  SourceAttribution class
+#
+class SourceAttribution:
+    fields = ('docname', 'seconds', 'elements', 'xml_bytes', 'media_bytes')
+
+    def __init__(self, docx, docname):
+        self.docx = docx
+        self.stack = [docname]
+        # docname -> [seconds, elements, xml_bytes, media_bytes]
+        self.records = {}
+        # (docname, first, last) ranges of top level body elements
+        self.segments = []
+
+        self.mark_time = time.time()
+        self.mark_index = len(docx.docbody)
+        self.mark_media = docx.media_bytes
+
+    def get_record(self, docname):
+        return self.records.setdefault(docname, [0.0, 0, 0, 0])
+
+    def switch(self):
+        '''
+           Close the current segment, and attribute it to the current document
+        '''
+        now = time.time()
+        index = len(self.docx.docbody)
+        record = self.get_record(self.stack[-1])
+        record[0] += now - self.mark_time
+        record[3] += self.docx.media_bytes - self.mark_media
+        if index > self.mark_index :
+            self.segments.append((self.stack[-1], self.mark_index, index))
+
+        self.mark_time = now
+        self.mark_index = index
+        self.mark_media = self.docx.media_bytes
+
+    def enter(self, docname):
+        '''
+           called at the start of an inlined source document
+        '''
+        self.switch()
+        self.stack.append(docname)
+
+    def leave(self):
+        '''
+           called at the end of an inlined source document
+        '''
+        self.switch()
+        if len(self.stack) > 1 :
+            self.stack.pop()
+
+    def finish(self):
+        '''
+           Close the last segment, and measure the body fragments of each document.
+           Body elements can be modified after they are appended,
+           so they are measured after the translation.
+        '''
+        self.switch()
+        body = self.docx.docbody
+        for docname, first, last in self.segments:
+            record = self.get_record(docname)
+            for elem in body[first:last]:
+                record[1] += sum(1 for x in elem.iter())
+                record[2] += len(etree.tostring(elem, encoding='UTF-8'))
+        self.segments = []
+
+    def get_rows(self):
+        '''
+           Get report rows, the most expensive document first
+        '''
+        rows = [ [docname] + record for docname, record in self.records.items() ]
+        rows.sort(key=lambda x: (-x[1], -x[3]))
+        return rows
+
+    def write(self, filename):
+        '''
+           Write the report as a CSV file
+        '''
+        f = open(filename, 'wb')
+        writer = csv.writer(f)
+        writer.writerow(self.fields)
+        for row in self.get_rows():
+            writer.writerow([row[0].encode('utf-8'), '%.6f' % row[1]] + row[2:])
+        f.close()
+
+    def summary(self, filename):
+        rows = self.get_rows()
+        if not rows :
+            return 'no documents'
+        return '%d documents written to %s, slowest is %s (%.2fs)' % (
+                len(rows), filename, rows[0][0], rows[0][1])
@@ -79,6 +79,9 @@ class DocxBuilder(Builder):
         self.write_doc(docname, doctree)
         logger.info('done')
 
+        for name, summary in self.writer.stats:
+            logger.info(bold(name + ': ') + summary)
+
     def write_doc(self, docname, doctree):
         destination = StringOutput(encoding='utf-8')
         self.writer.write(doctree, destination)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinx-docxbuilder cache
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Persistent content-addressed cache shared by builds.
+
+    :license: MIT, see LICENSE for details.
+"""
+
+import os
+import hashlib
+import tempfile
+
+
+def make_key(*parts):
+    '''
+       Make a cache key from strings (or objects which have a stable repr)
+    '''
+    sha = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        elif not isinstance(part, str):
+            part = repr(part)
+        sha.update(str(len(part)))
+        sha.update(':')
+        sha.update(part)
+    return sha.hexdigest()
+
+def sorted_items(d):
+    '''
+       Items of a dictionary in a stable order for make_key
+    '''
+    return sorted(d.items())
+
+#
+#  ContentCache class
+#   Entries are files named by their key. The modification time of an entry
+#   is updated when it is read, and the least recently used entries are
+#   removed when the cache grows larger than 'max_bytes'. Pinned entries are
+#   in use by the build, and they are not removed until they are released.
+#
+class ContentCache:
+    def __init__(self, directory, max_bytes=64*1024*1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = None
+        self.pinned = set()
+        self.hits = 0
+        self.misses = 0
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def has(self, key):
+        '''
+           Check an entry without counting a hit or a miss
+        '''
+        return os.path.isfile(self.get_path(key))
+
+    def touch(self, key):
+        '''
+           Mark an entry as recently used without reading it, and count a hit
+        '''
+        try:
+            os.utime(self.get_path(key), None)
+        except OSError:
+            return False
+        self.hits += 1
+        return True
+
+    def get(self, key):
+        '''
+           Read an entry, or return None
+        '''
+        path = self.get_path(key)
+        try:
+            f = open(path, 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            os.utime(path, None)
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        '''
+           Write an entry atomically, and evict old entries if needed
+        '''
+        path = self.get_path(key)
+        dirname = os.path.dirname(path)
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            os.rename(tmpname, path)
+        except (IOError, OSError):
+            return False
+
+        if self.size is None:
+            self.size = self.get_total_size()
+        else:
+            self.size += len(data)
+        if self.max_bytes and self.size > self.max_bytes:
+            self.evict()
+        return True
+
+    def pin(self, key):
+        '''
+           Keep an entry from being evicted, until release is called
+        '''
+        self.pinned.add(key)
+
+    def release(self):
+        '''
+           Release the pinned entries, and evict old entries if needed
+        '''
+        self.pinned.clear()
+        if self.max_bytes and self.size is not None and self.size > self.max_bytes:
+            self.evict()
+
+    def get_entries(self):
+        '''
+           Get (mtime, size, path) of all entries
+        '''
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.startswith('.tmp-'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def get_total_size(self):
+        return sum(x[1] for x in self.get_entries())
+
+    def evict(self):
+        '''
+           Remove the least recently used entries down to 3/4 of 'max_bytes'
+        '''
+        entries = self.get_entries()
+        entries.sort()
+        size = sum(x[1] for x in entries)
+        limit = self.max_bytes * 3 / 4
+        for mtime, fsize, path in entries:
+            if size <= limit:
+                break
+            if os.path.basename(path) in self.pinned:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= fsize
+        self.size = size
+
+    def summary(self):
+        total = self.hits + self.misses
+        if total:
+            rate = 100.0 * self.hits / total
+        else:
+            rate = 0.0
+        return '%d hits, %d misses (%.0f%% hit rate)' % (self.hits, self.misses, rate)
@@ -22,8 +22,14 @@ import re
 import time
 import os
 from os.path import join
-import tempfile
 import sys
+import copy
+import hashlib
+import zlib
+import struct
+import cPickle as pickle
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 
 # All Word prefixes / namespace matches used in document.xml & core.xml.
@@ -60,6 +66,24 @@ nsprefixes = {
     'xml':'http://www.w3.org/XML/1998/namespace'
     }
 
+# Images in these formats are compressed already, so they are stored as they are
+stored_media_extensions = ('.png', '.jpeg', '.jpg', '.gif')
+
+# docx_compression --> (compress type, zlib level)
+compression_modes = {
+    'stored': (zipfile.ZIP_STORED, 0),
+    'fast': (zipfile.ZIP_DEFLATED, 1),
+    'default': (zipfile.ZIP_DEFLATED, zlib.Z_DEFAULT_COMPRESSION),
+    'max': (zipfile.ZIP_DEFLATED, 9),
+    }
+# Parts are deflated in chunks of this size concurrently
+deflate_chunk_size = 256 * 1024
+
+# Markup of the 'fast' XML backend, paragraphs are parsed from it at once
+fast_paragraph_start = '<w:p xmlns:w="%s">' % nsprefixes['w']
+fast_page_break = '<w:r><w:lastRenderedPageBreak/></w:r>'
+fast_line_break = '<w:r><w:br/></w:r>'
+
 Enum_Types = {
     'arabic':'decimal',
     'loweralpha':'lowerLetter',
@@ -68,6 +92,27 @@ Enum_Types = {
     'upperroman':'upperRoman'
     }
 
+# Names resolved with 'nsprefixes', they are interned once
+#   'ns:tag' --> '{namespace}tag'
+_qnames = {}
+#   (tag, attribute names) --> nsmap
+_nsmaps = {}
+# Fixed subtrees which are cloned, see get_prototype
+_prototypes = {}
+#   (filename, child_dir) --> path found by find_file
+_found_files = {}
+#   content digest of a style file --> template info, see DocxDocument.make_template_info
+_template_infos = {}
+#   content digest of a style file --> parsed trees, which are copied for each document
+_template_trees = {}
+
+# bump this when the template info changes
+template_info_version = 2
+#   'ns:a/ns:b' --> '{namespace}a/{namespace}b'
+_qpaths = {}
+#   (path, namespaces) --> compiled XPath
+_xpaths = {}
+
 #####################
 def norm_name(tagname, namespaces=nsprefixes):
     '''
@@ -75,20 +120,54 @@ def norm_name(tagname, namespaces=nsprefixes):
           'ns:tag' --> '{namespace}tag'
           'tag' --> 'tag'
     '''
+    if namespaces is nsprefixes :
+      qname = _qnames.get(tagname)
+      if qname is not None :
+        return qname
+    qname = tagname
     ns_name = tagname.split(':', 1)
     if len(ns_name) >1 :
-      tagname = "{%s}%s" % (namespaces[ns_name[0]], ns_name[1])
-    return tagname
+      qname = "{%s}%s" % (namespaces[ns_name[0]], ns_name[1])
+    if namespaces is nsprefixes :
+      _qnames[tagname] = qname
+    return qname
+
+def norm_path(path):
+    '''
+       Convert a relative path of child tags for 'find' and 'findall'.
+          'ns:a/ns:b' --> '{namespace}a/{namespace}b'
+    '''
+    qpath = _qpaths.get(path)
+    if qpath is None :
+      qpath = '/'.join([ norm_name(x) for x in path.split('/') ])
+      _qpaths[path] = qpath
+    return qpath
+
+def compile_xpath(path, ns=nsprefixes):
+    '''
+       Get the compiled XPath of 'path', which is compiled once.
+    '''
+    if ns is nsprefixes :
+      key = (path, None)
+    else:
+      key = (path, tuple(sorted(ns.items())))
+    xpath = _xpaths.get(key)
+    if xpath is None :
+      xpath = etree.XPath(path, namespaces=ns)
+      _xpaths[key] = xpath
+    return xpath
 
 def get_elements(xml, path, ns=nsprefixes):
     '''
        Get elements from a Element tree with 'path'.
     '''
     result = []
+    if xml is None :
+      return result
     try:
-      result = xml.xpath(path, namespaces=ns)
-    except:
-      pass
+      result = compile_xpath(path, ns)(xml)
+    except etree.XPathError, exc:
+      print "Error in get_elements:", path, exc
     return result
 
 def append_element(elem, xml, path=None, index=0, ns=nsprefixes):
@@ -98,10 +177,10 @@ def append_element(elem, xml, path=None, index=0, ns=nsprefixes):
     try:
       dist = xml
       if path :
-        dist = xml.xpath(path, namespaces=ns)
+        dist = compile_xpath(path, ns)(xml)
       dist[index].append(elem)
       return True
-    except:
+    except (etree.XPathError, IndexError, TypeError):
       print "Error  in append_element"
 
     return False
@@ -112,16 +191,106 @@ def find_file(filename, child_dir=None):
     '''
     fname = filename
     if not os.access( filename ,os.F_OK):
+      # the walk of sys.path is done once for each file
+      fname = _found_files.get((filename, child_dir))
+      if fname is not None and os.access(fname, os.F_OK):
+        return fname
       for pth in sys.path:
         if child_dir :
           pth = join(pth, child_dir)
         fname = join(pth, filename)
         if os.access(fname, os.F_OK):
+          _found_files[(filename, child_dir)] = fname
           break
         else:
           fname=None
     return fname
 
+def get_file_digest(filename):
+    '''
+       Get the content digest of a file
+    '''
+    sha = hashlib.sha1()
+    f = open(filename, 'rb')
+    try:
+      for data in iter(lambda: f.read(65536), ''):
+        sha.update(data)
+    finally:
+      f.close()
+    return sha.hexdigest()
+
+def load_template_info(digest, cache_dir=None):
+    '''
+       Get the template info of a style file from the memory, or 'cache_dir'
+       Return (info, where it is found), or (None, None)
+    '''
+    info = _template_infos.get(digest)
+    if info is not None :
+      return info, 'memory'
+    if not cache_dir :
+      return None, None
+    try:
+      f = open(join(cache_dir, digest + '.pickle'), 'rb')
+      try:
+        version, info = pickle.load(f)
+      finally:
+        f.close()
+    except Exception:
+      return None, None
+    if version != template_info_version :
+      return None, None
+    _template_infos[digest] = info
+    return info, 'disk'
+
+def save_template_info(digest, info, cache_dir=None):
+    '''
+       Keep the template info of a style file in the memory, and in 'cache_dir'
+    '''
+    _template_infos[digest] = info
+    if not cache_dir :
+      return
+    try:
+      if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+      filename = join(cache_dir, digest + '.pickle')
+      tmpname = '%s.%d' % (filename, os.getpid())
+      f = open(tmpname, 'wb')
+      try:
+        pickle.dump((template_info_version, info), f, pickle.HIGHEST_PROTOCOL)
+      finally:
+        f.close()
+      os.rename(tmpname, filename)
+    except (IOError, OSError):
+      pass
+
+def parse_fragment(xmlcontent):
+    '''
+       Parse an element serialized out of its document. The declarations
+       of the document which it does not use are removed.
+    '''
+    elem = etree.fromstring(xmlcontent)
+    etree.cleanup_namespaces(elem)
+    return elem
+
+def escape_xml(text, quote=False):
+    '''
+       Escape text for the markup of the 'fast' XML backend.
+       Carriage returns are escaped, because a parser replaces them.
+    '''
+    if isinstance(text, unicode) :
+      text = text.encode('utf-8')
+    if '&' in text :
+      text = text.replace('&', '&amp;')
+    if '<' in text :
+      text = text.replace('<', '&lt;')
+    if '>' in text :
+      text = text.replace('>', '&gt;')
+    if '\r' in text :
+      text = text.replace('\r', '&#13;')
+    if quote and '"' in text :
+      text = text.replace('"', '&quot;')
+    return text
+
 def get_enumerate_type(typ):
   '''
        
@@ -163,7 +332,14 @@ def parse_tag_list(tag):
 
 def extract_nsmap(tag, attributes):
     '''
+       Get the nsmap of prefixes used by the tag and the attributes.
+       The result is shared, so it must not be modified.
     '''
+    key = (tag, tuple(attributes))
+    result = _nsmaps.get(key)
+    if result is not None :
+      return result
+
     result = {}
     ns_name = tag.split(':', 1)
     if len(ns_name) > 1 and nsprefixes.get(ns_name[0]) :
@@ -174,6 +350,7 @@ def extract_nsmap(tag, attributes):
       if len(ns_name) > 1 and nsprefixes.get(ns_name[0]) :
           result[ns_name[0]] = nsprefixes[ns_name[0]]
 
+    _nsmaps[key] = result
     return result
 
 def make_element_tree(arg, _xmlns=None):
@@ -203,29 +380,38 @@ def make_element_tree(arg, _xmlns=None):
 
     return newele
 
+def get_prototype(key, make_tree):
+    '''
+       Get a copy of the fixed subtree of 'key', which is made from
+       the tree list of 'make_tree()' at the first time.
+       Variable attributes and text are filled in by the caller.
+    '''
+    prototype = _prototypes.get(key)
+    if prototype is None :
+      prototype = make_element_tree(make_tree())
+      _prototypes[key] = prototype
+    return copy.deepcopy(prototype)
+
 def get_child_element(xml, p):
     '''
        
     '''
-    elems = get_elements(xml, p)
-    if elems == [] :
-      ele = make_element_tree([p])
-      xml.append(ele)
-      return ele
-    return elems[0]
+    elem = xml.find(norm_name(p))
+    if elem is None :
+      elem = make_element_tree([p])
+      xml.append(elem)
+    return elem
 
 def set_attributes(xml, path, attributes):
     '''
        
     '''
-    elems = get_elements(xml, path)
-    if elems == [] :
+    elem = xml.find(norm_path(path))
+    if elem is None :
       pathes = path.split('/')
       elem=xml
       for p in pathes:
         elem = get_child_element(elem, p)
-    else:
-      elem = elems[0]
 
     for attr in attributes:
       elem.set(norm_name(attr), attributes[attr])
@@ -235,19 +421,225 @@ def get_attribute(xml, path, name):
     '''
        
     '''
-    elems = get_elements(xml, path)
-    if elems == [] :
+    if xml is None :
+      return None
+    elem = xml.find(norm_path(path))
+    if elem is None :
       return None
-    return elems[0].attrib[norm_name(name)]
+    return elem.attrib[norm_name(name)]
+
+def strip_namespace_declarations(data, nsmap):
+    '''
+       Remove the declarations of 'nsmap', which are in scope already,
+       from the start tag of a serialized element
+    '''
+    end = data.index('>')
+    start_tag = data[:end]
+    for prefix, uri in nsmap.items():
+      if prefix is None :
+        start_tag = start_tag.replace(' xmlns="%s"' % uri, '', 1)
+      else:
+        start_tag = start_tag.replace(' xmlns:%s="%s"' % (prefix, uri), '', 1)
+    return start_tag + data[end:]
+
+def write_xml_part(f, tree):
+    '''
+       Serialize an XML part into the file object 'f' incrementally.
+       Children of the root element and their children are written one by one,
+       so the serialization of a large part (document.xml) is not held at once.
+       They are serialized as standalone elements, so the namespace declarations
+       of the root element are stripped from them, to be the same as
+       serializing the whole tree.
+    '''
+    # the root element and its children without their contents,
+    # the contents are written at the markers
+    shell = etree.Element(tree.tag, dict(tree.attrib), nsmap=tree.nsmap)
+    shell.text = tree.text
+    contents = []
+    for child in tree:
+      if isinstance(child.tag, basestring) and len(child) :
+        sub = etree.SubElement(shell, child.tag, dict(child.attrib))
+        sub.text = child.text
+        sub.tail = child.tail
+        sub.append(etree.Comment('part-%d' % len(contents)))
+        contents.append(list(child))
+      else:
+        shell.append(etree.Comment('part-%d' % len(contents)))
+        contents.append([child])
+
+    nsmap = tree.nsmap
+    data = etree.tostring(shell, xml_declaration=True, encoding='UTF-8', standalone='yes')
+    for i, elements in enumerate(contents):
+      head, data = data.split('<!--part-%d-->' % i, 1)
+      f.write(head)
+      for x in elements:
+        if isinstance(x.tag, basestring) :
+          f.write(strip_namespace_declarations(etree.tostring(x, encoding='UTF-8'), nsmap))
+        else:
+          f.write(etree.tostring(x, encoding='UTF-8'))
+    f.write(data)
+
+def deflate_chunk(data, level, final):
+    '''
+       Deflate a chunk of a part independently. Chunks except the last one
+       end with a sync flush, so that they are concatenated to a deflate stream.
+       The elapsed time is returned with the data.
+    '''
+    start = time.time()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    data = compressor.compress(data)
+    if final :
+      data += compressor.flush()
+    else:
+      data += compressor.flush(zlib.Z_SYNC_FLUSH)
+    return data, time.time() - start
+
+#
+#  ZipPartWriter class
+#   A file object to write a part into a zip file while it is serialized,
+#   like 'ZipFile.open(name, "w")' of Python 3.
+#   If a thread pool is given, chunks of the part are deflated in the pool,
+#   and they are written in order.
+#
+class ZipPartWriter:
+  def __init__(self, zipfileobj, arcname, compress_type=None,
+               level=zlib.Z_DEFAULT_COMPRESSION, pool=None, max_pending=4):
+    if compress_type is None :
+      compress_type = zipfileobj.compression
+
+    zinfo = zipfile.ZipInfo(arcname, time.localtime(time.time())[:6])
+    zinfo.compress_type = compress_type
+    zinfo.external_attr = 0600 << 16
+    zinfo.file_size = zinfo.compress_size = zinfo.CRC = 0
+    zinfo.header_offset = zipfileobj.fp.tell()
+    zipfileobj._writecheck(zinfo)
+    zipfileobj._didModify = True
+
+    # the header is written again with the sizes when the part is closed
+    zipfileobj.fp.write(zinfo.FileHeader(False))
+
+    self.zipfile = zipfileobj
+    self.zinfo = zinfo
+    self.level = level
+    self.compressor = None
+    self.pool = None
+    if compress_type == zipfile.ZIP_DEFLATED :
+      if pool is not None :
+        self.pool = pool
+        self.chunks = []
+        self.chunks_size = 0
+        self.pending = []
+        self.max_pending = max_pending
+      else:
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+
+    # seconds of deflating, and waiting for the pool
+    self.compress_time = 0.0
+    self.wait_time = 0.0
+
+  def write(self, data):
+    zinfo = self.zinfo
+    zinfo.file_size += len(data)
+    zinfo.CRC = zlib.crc32(data, zinfo.CRC) & 0xffffffff
+    if self.pool is not None :
+      self.chunks.append(data)
+      self.chunks_size += len(data)
+      if self.chunks_size >= deflate_chunk_size :
+        self.submit_chunk(False)
+      return
+    if self.compressor is not None :
+      start = time.time()
+      data = self.compressor.compress(data)
+      self.compress_time += time.time() - start
+    self.write_data(data)
+
+  def write_data(self, data):
+    self.zinfo.compress_size += len(data)
+    self.zipfile.fp.write(data)
+
+  def submit_chunk(self, final):
+    '''
+       Deflate the buffered data in the pool, and write finished chunks.
+       Chunks in the pool are limited, to bound the memory.
+    '''
+    data = ''.join(self.chunks)
+    self.chunks = []
+    self.chunks_size = 0
+    self.pending.append(self.pool.apply_async(deflate_chunk, (data, self.level, final)))
+    while len(self.pending) > self.max_pending or (final and self.pending) :
+      self.write_chunk()
+
+  def write_chunk(self):
+    start = time.time()
+    data, elapsed = self.pending.pop(0).get()
+    self.wait_time += time.time() - start
+    self.compress_time += elapsed
+    self.write_data(data)
+
+  def close(self):
+    zinfo = self.zinfo
+    if self.pool is not None :
+      self.submit_chunk(True)
+      self.pool = None
+    if self.compressor is not None :
+      start = time.time()
+      data = self.compressor.flush()
+      self.compress_time += time.time() - start
+      self.write_data(data)
+      self.compressor = None
+
+    if zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT :
+      raise zipfile.LargeZipFile('%s is too large' % zinfo.filename)
+
+    fp = self.zipfile.fp
+    end = fp.tell()
+    fp.seek(zinfo.header_offset)
+    fp.write(zinfo.FileHeader(False))
+    fp.seek(end)
+    self.zipfile.filelist.append(zinfo)
+    self.zipfile.NameToInfo[zinfo.filename] = zinfo
+
+def copy_zip_entry(src, zinfo, dst):
+    '''
+       Copy an entry of the zip file 'src' into 'dst' as its compressed data,
+       without decompressing and compressing it again.
+    '''
+    if zinfo.flag_bits & 0x01 or zinfo.file_size > zipfile.ZIP64_LIMIT or \
+       zinfo.compress_size > zipfile.ZIP64_LIMIT or zinfo.header_offset > zipfile.ZIP64_LIMIT :
+      # encrypted or zip64 entries are copied through their contents
+      dst.writestr(zinfo, src.read(zinfo.filename))
+      return
+
+    src.fp.seek(zinfo.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, src.fp.read(zipfile.sizeFileHeader))
+    src.fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+    data = src.fp.read(zinfo.compress_size)
+
+    newinfo = zipfile.ZipInfo(zinfo.filename, zinfo.date_time)
+    newinfo.compress_type = zinfo.compress_type
+    newinfo.external_attr = zinfo.external_attr
+    # sizes are written in the local header instead of a data descriptor
+    newinfo.flag_bits = zinfo.flag_bits & ~0x08
+    newinfo.CRC = zinfo.CRC
+    newinfo.file_size = zinfo.file_size
+    newinfo.compress_size = zinfo.compress_size
+    newinfo.header_offset = dst.fp.tell()
+    dst._writecheck(newinfo)
+    dst._didModify = True
+    dst.fp.write(newinfo.FileHeader(False))
+    dst.fp.write(data)
+    dst.filelist.append(newinfo)
+    dst.NameToInfo[newinfo.filename] = newinfo
 
 #
 #  DocxDocument class
 #   This class for analizing docx-file
 #
 class DocxDocument:
-  def __init__(self, docxfile=None):
+  def __init__(self, docxfile=None, cache_dir=None):
     '''
       Constructor
+      The parsed template is kept in 'cache_dir' by the content of 'docxfile'.
     '''
     self.title = ""
     self.subject = ""
@@ -257,37 +649,107 @@ class DocxDocument:
     self.descriptions = ""
     self.keywords = []
     self.stylenames = {}
+    # style name --> numbering ID, or indents of the numbering
+    self.numbering_style_ids = {}
+    self.numbering_lefts = {}
+    # 'memory', 'disk' or 'parsed', and the time to set up the template
+    self.template_source = None
+    self.template_time = 0.0
 
     if docxfile :
-      self.set_document(docxfile)
+      self.set_document(docxfile, cache_dir)
       self.docxfile = docxfile
 
-  def set_document(self, fname):
+  def set_document(self, fname, cache_dir=None):
     '''
       set docx document 
+      The parsed trees of the style file are kept in the memory, and copied
+      for each document. The data derived from them are kept in 'cache_dir',
+      so another process parses only the parts to be changed (styles and numbering).
+      document.xml is parsed when 'document' or 'docbody' is used.
     '''
     if fname :
+      start = time.time()
       self.docxfile = fname
       self.docx = zipfile.ZipFile(fname)
 
-      self.document = self.get_xmltree('word/document.xml')
-      self.docbody = get_elements(self.document, '/w:document/w:body')[0]
+      digest = get_file_digest(fname)
+      info, self.template_source = load_template_info(digest, cache_dir)
+      trees = _template_trees.get(digest)
+      if info is None :
+        self.template_source = 'parsed'
+        self.document = self.get_xmltree('word/document.xml')
+        self.docbody = get_elements(self.document, '/w:document/w:body')[0]
+        self.numbering = self.get_xmltree('word/numbering.xml')
+        self.styles = self.get_xmltree('word/styles.xml')
+        self.extract_stylenames()
+        self.find_paper_info()
+        self.find_coverpage()
+        save_template_info(digest, self.make_template_info(), cache_dir)
+        _template_trees[digest] = copy.deepcopy(self.get_template_trees())
+      else:
+        if trees is None :
+          trees = {'numbering': self.get_xmltree('word/numbering.xml'),
+                   'styles': self.get_xmltree('word/styles.xml'),
+                   'paper_info': parse_fragment(info['paper_info']),
+                   'coverpage': info['coverpage'] and parse_fragment(info['coverpage'])}
+          _template_trees[digest] = copy.deepcopy(trees)
+        else:
+          # trees are copied for each document, because they are changed
+          trees = copy.deepcopy(trees)
+        self.numbering = trees['numbering']
+        self.styles = trees['styles']
+        self.paper_info = trees['paper_info']
+        self.coverpage = trees['coverpage']
+        self.document_width, self.document_height = info['paper_size']
+        self.stylenames = dict(info['stylenames'])
+        self.numbering_style_ids = dict(info['numbering_style_ids'])
+        self.numbering_lefts = dict(info['numbering_lefts'])
 
-      self.numbering = self.get_xmltree('word/numbering.xml')
-      self.styles = self.get_xmltree('word/styles.xml')
-      self.extract_stylenames()
       self.paragraph_style_id = self.stylenames['Normal']
       self.character_style_id = self.stylenames['Default Paragraph Font']
+      self.template_time = time.time() - start
+
+  def __getattr__(self, name):
+    '''
+      Parse document.xml of the style file when it is used first
+    '''
+    if name in ('document', 'docbody') and self.__dict__.get('docx') is not None :
+      self.document = self.get_xmltree('word/document.xml')
+      self.docbody = get_elements(self.document, '/w:document/w:body')[0]
+      return self.__dict__[name]
+    raise AttributeError(name)
 
+  def make_template_info(self):
+    '''
+      Make the template info, which is the data derived from the parsed parts.
+      The parts must not be changed yet.
+    '''
+    styles = ('ListBullet', 'ListNumber')
+    coverpage = None
+    if self.coverpage is not None :
+      coverpage = etree.tostring(self.coverpage, with_tail=False)
+    return {'stylenames': dict(self.stylenames),
+            'numbering_style_ids': dict([ (x, self.get_numbering_style_id(x)) for x in styles ]),
+            'numbering_lefts': dict([ (x, self.get_numbering_left(x)) for x in styles ]),
+            'paper_size': (self.document_width, self.document_height),
+            'paper_info': etree.tostring(self.paper_info, with_tail=False),
+            'coverpage': coverpage}
 
-    return self.document
+  def get_template_trees(self):
+    return {'numbering': self.numbering,
+            'styles': self.styles,
+            'paper_info': self.paper_info,
+            'coverpage': self.coverpage}
 
-  def get_xmltree(self, fname):
+  def get_xmltree(self, fname, xmlcontent=None):
     '''
-      Extract a document tree from the docx file
+      Extract a document tree from the docx file, or 'xmlcontent'
     '''
     try:
-      return etree.fromstring(self.docx.read(fname))
+      if xmlcontent is None :
+        xmlcontent = self.docx.read(fname)
+      return etree.fromstring(xmlcontent)
     except:
       return None
     
@@ -309,6 +771,10 @@ class DocxDocument:
     return self.stylenames
 
   def get_paper_info(self):
+    print self.document_width, self.document_height
+    return self.paper_info
+
+  def find_paper_info(self):
     self.paper_info = get_elements(self.document,'/w:document/w:body/w:sectPr')[0]
     self.paper_size = get_elements(self.document,'/w:document/w:body/w:sectPr/w:pgSz')[0]
     self.paper_margin = get_elements(self.document,'/w:document/w:body/w:sectPr/w:pgMar')[0]
@@ -318,11 +784,12 @@ class DocxDocument:
     # paper info: unit ---> 2099 mm = 11900 paper_unit
     self.document_width = int(width * 2099 / 11900)  # mm
     self.document_height = int(height * 2970 / 16840)  # mm
-
-    print self.document_width, self.document_height
     return self.paper_info
     
   def get_coverpage(self):
+    return self.coverpage
+
+  def find_coverpage(self):
     coverInfo=get_attribute(self.docbody, 'w:sdt/w:sdtPr/w:docPartObj/w:docPartGallery', 'w:val')
     if coverInfo == "Cover Pages":
       self.coverpage=get_elements(self.docbody,'w:sdt')[0]
@@ -410,6 +877,36 @@ class DocxDocument:
     os.chdir(prev_dir) # restore previous working dir
     return docxfile
 
+  def copy_docx(self, docx_filename, files_to_skip=[], copy_part=None):
+    '''
+      Make a new docx file, and copy parts of this docx file except 'files_to_skip'
+      into it as they are compressed, or with 'copy_part(zipfile, zipinfo)'.
+      Return the zip file to write other parts.
+    '''
+    docxfile = zipfile.ZipFile(docx_filename, mode='w', compression=zipfile.ZIP_DEFLATED)
+
+    files_to_ignore = ['.DS_Store'] # nuisance from some os's
+    for zinfo in self.docx.infolist():
+      if zinfo.filename.endswith('/') or zinfo.filename in files_to_skip :
+        continue
+      if os.path.basename(zinfo.filename) in files_to_ignore :
+        continue
+      if copy_part is not None :
+        copy_part(docxfile, zinfo)
+      else:
+        copy_zip_entry(self.docx, zinfo, docxfile)
+
+    return docxfile
+
+  def read_part(self, fname):
+    '''
+      Read a part of this docx file, or raise RuntimeError if it is missing
+    '''
+    try:
+      return self.docx.read(fname)
+    except KeyError:
+      raise RuntimeError('You need %r file in template' % fname)
+
   def get_filelist(self):
       '''
          Extract file names from docx file
@@ -452,6 +949,15 @@ class DocxDocument:
   def get_numbering_style_id(self, style):
     '''
        
+    '''
+    if style in self.numbering_style_ids :
+      return self.numbering_style_ids[style]
+    self.numbering_style_ids[style] = self.find_numbering_style_id(style)
+    return self.numbering_style_ids[style]
+
+  def find_numbering_style_id(self, style):
+    '''
+       
     '''
     try:
       style_elems = get_elements(self.styles, '/w:styles/w:style')
@@ -514,6 +1020,14 @@ class DocxDocument:
   def get_numbering_left(self, style):
     '''
        get numbering indeces
+    '''
+    if style not in self.numbering_lefts :
+      self.numbering_lefts[style] = self.find_numbering_left(style)
+    return list(self.numbering_lefts[style])
+
+  def find_numbering_left(self, style):
+    '''
+       
     '''
     abstractNums=get_elements(self.numbering, 'w:abstractNum')
 
@@ -564,6 +1078,113 @@ class DocxDocument:
             paratextlist.append(paratext)                    
     return paratextlist        
 
+#
+#  NumberingRegistry class
+#   This class keeps allocated numIds and the paragraphs which refer them
+#
+class NumberingRegistry:
+  def __init__(self, nums=None):
+    '''
+      Constructor
+    '''
+    self.nums = []
+    self.ids = set()
+    self.max_id = 0
+    self.paragraphs = {}
+
+    if nums :
+      for num in nums :
+        self.add_num(num)
+
+  def add_num(self, num):
+    '''
+       Register a 'w:num' element, and return its numId
+    '''
+    nid = int(num.attrib[norm_name('w:numId')])
+    self.nums.append(num)
+    self.ids.add(nid)
+    if nid > self.max_id :  self.max_id = nid
+    return nid
+
+  def has_id(self, nId):
+    '''
+       Check whether 'nId' is already allocated
+    '''
+    return int(nId) in self.ids
+
+  def get_ids(self):
+    '''
+       Get all numIds in the registered order
+    '''
+    tag = norm_name('w:numId')
+    return [ num.attrib[tag] for num in self.nums ]
+
+  def add_paragraph(self, nId, paragraph):
+    '''
+       Record a paragraph which refers 'nId'
+    '''
+    self.paragraphs.setdefault(int(nId), []).append(paragraph)
+
+  def remove_paragraph(self, nId, paragraph):
+    '''
+       Forget a paragraph which refers 'nId'
+    '''
+    paras = self.paragraphs.get(int(nId))
+    if paras and paragraph in paras :
+      paras.remove(paragraph)
+
+  def get_paragraphs(self, nId):
+    '''
+       Get paragraphs which refer 'nId'
+    '''
+    return self.paragraphs.get(int(nId), [])
+
+#
+#  TableCursor class
+#   This class holds the current row, cell and paragraph of a composing table
+#
+class TableCursor:
+  def __init__(self, table):
+    '''
+      Constructor
+    '''
+    self.table = table
+    self.row = None
+    self.cells = []
+    self.cell = None
+    self.last_paragraph = None
+    self.nrows = 0
+    self.colsize = None
+    self.row_prototypes = {}
+
+  def add_row(self, row, cells):
+    '''
+       Append a row to the table, and move the cursor to it
+    '''
+    self.table.append(row)
+    self.row = row
+    self.cells = cells
+    self.cell = None
+    self.nrows += 1
+    return row
+
+  def get_cell(self, n=0):
+    '''
+       Move the cursor to the n-th cell of the current row
+    '''
+    self.cell = self.cells[n]
+    return self.cell
+
+  def append_paragraph(self, paragraph, n=None):
+    '''
+       Append a paragraph to the current (or the n-th) cell
+    '''
+    if n is not None :
+      self.get_cell(n)
+    self.cell.append(paragraph)
+    self.last_paragraph = paragraph
+    return paragraph
+
 #
 # DocxComposer Class
 #
@@ -591,19 +1212,43 @@ class DocxComposer:
     self.sizeof_field_list = [2000,5500]
 
     self.abstractNums = []
-    self.numids = []
+    self.numbering_registry = NumberingRegistry()
+    self.numids = self.numbering_registry.nums
 
     self.images = 0
+    self.media_bytes = 0
+    # [media name, image path, relationship, max width, max height] of each media part
+    self.media_files = []
+    # content digest -> (relationship ID, entry of media_files)
+    self.media_parts = {}
+    # link of an external image -> relationship ID
+    self.media_links = {}
+    # image path -> content digest
+    self.media_digests = {}
+    self.media_reused = 0
+    self.media_saved_bytes = 0
     self.nocoverpage = False
-
-    if stylefile == None :
-      self.template_dir = None
-    else :
+    # 'lxml' makes paragraphs element by element, 'fast' parses their markup
+    self.xml_backend = 'lxml'
+    # a key of compression_modes, and threads to deflate parts (None: the number of CPUs)
+    self.compression = 'default'
+    self.compression_threads = None
+    self.compression_pool_size = 1
+    self.compression_time = 0.0
+    self.compression_wait = 0.0
+    self.compression_bytes_in = 0
+    self.compression_bytes_out = 0
+
+    # parts of the template are read from the style file (no longer extracted)
+    self.template_dir = None
+
+    if stylefile != None :
       self.new_document(stylefile)
 
-  def set_style_file(self, stylefile):
+  def set_style_file(self, stylefile, cache_dir=None):
     '''
        Set style file 
+       The parsed style file is kept in 'cache_dir' between processes.
     '''
     fname = find_file(stylefile, 'sphinx-docxbuilder/docx')
 
@@ -611,25 +1256,17 @@ class DocxComposer:
       print "Error: style file( %s ) not found" % stylefile
       return None
       
-    self.styleDocx = DocxDocument(fname)
-
-    self.template_dir = tempfile.mkdtemp(prefix='docx-')
-    result = self.styleDocx.extract_files(self.template_dir)
+    self.styleDocx = DocxDocument(fname, cache_dir)
 
-    if not result :
-      print "Unexpected error in copy_docx_to_tempfile"
-      shutil.rmtree(temp_dir, True)
-      self.template_dir = None
-      return 
-
-    self.stylenames = self.styleDocx.extract_stylenames()
+    self.stylenames = self.styleDocx.stylenames
     self.paper_info = self.styleDocx.get_paper_info()
     self.bullet_list_indents = self.get_numbering_left('ListBullet')
     self.bullet_list_numId = self.styleDocx.get_numbering_style_id('ListBullet')
     self.number_list_indent = self.get_numbering_left('ListNumber')[0]
     self.number_list_numId = self.styleDocx.get_numbering_style_id('ListNumber')
     self.abstractNums = get_elements(self.styleDocx.numbering, 'w:abstractNum')
-    self.numids = get_elements(self.styleDocx.numbering, 'w:num')
+    self.numbering_registry = NumberingRegistry(get_elements(self.styleDocx.numbering, 'w:num'))
+    self.numids = self.numbering_registry.nums
     self.numbering = make_element_tree(['w:numbering'])
 
     return
@@ -641,33 +1278,27 @@ class DocxComposer:
     '''
        
     '''
-    result = []
-    for num_elem in self.numids :
-        nid = num_elem.attrib[norm_name('w:numId')]
-        result.append( nid )
-    return result
+    return self.numbering_registry.get_ids()
 
   def get_max_numbering_id(self):
     '''
        
     '''
-    max_id = 0
-    num_ids = self.get_numbering_ids()
-    for x in num_ids :
-      if int(x) > max_id :  max_id = int(x)
-    return max_id
+    return self.numbering_registry.max_id
 
   def delete_template(self):
     '''
        Delete the temporary directory which we use compose a new document. 
     '''
-    shutil.rmtree(self.template_dir, True)
+    if self.template_dir :
+      shutil.rmtree(self.template_dir, True)
+      self.template_dir = None
 
-  def new_document(self, stylefile):
+  def new_document(self, stylefile, cache_dir=None):
     '''
        Preparing a new document
     '''
-    self.set_style_file(stylefile)
+    self.set_style_file(stylefile, cache_dir)
     self.document = make_element_tree([['w:document'],[['w:body']]])
     self.docbody = get_elements(self.document, '/w:document/w:body')[0]
     self.current_docbody = self.docbody
@@ -692,8 +1323,6 @@ class DocxComposer:
     '''
       Save the composed document to the docx file 'docxfilename'.
     '''
-    assert os.path.isdir(self.template_dir)
-
     self.coreproperties()
     self.appproperties()
     self.contenttypes()
@@ -725,16 +1354,47 @@ class DocxComposer:
                      self._websettings:'word/webSettings.xml',
                      self._wordrelationships:'word/_rels/document.xml.rels'}
 
-    docxfile = self.styleDocx.restruct_docx(self.template_dir, docxfilename, treesandfiles.values())
-
-    for tree in treesandfiles:
-        if tree != None:
-            #print 'Saving: '+treesandfiles[tree]    
-            treestring =  etree.tostring(tree, xml_declaration=True, encoding='UTF-8', standalone='yes')
-            docxfile.writestr(treesandfiles[tree],treestring)
+    if self.compression not in compression_modes :
+      raise ValueError('unknown compression: %r' % (self.compression,))
+
+    # large parts are deflated in chunks concurrently (zlib releases the GIL)
+    pool = None
+    threads = self.compression_threads
+    if threads is None :
+      threads = multiprocessing.cpu_count()
+    if threads > 1 and compression_modes[self.compression][0] == zipfile.ZIP_DEFLATED :
+      pool = ThreadPool(threads)
+    self.compression_pool_size = pool and threads or 1
+
+    # parts of the template are copied as they are compressed in the default mode,
+    # media of the template are replaced by images of the same name
+    copy_part = None
+    if self.compression != 'default' :
+      copy_part = lambda dst, zinfo: self.recompress_part(dst, zinfo, pool)
+    try:
+      docxfile = self.styleDocx.copy_docx(docxfilename,
+                          treesandfiles.values() + self.get_media_archive_names(), copy_part)
+      self.write_media(docxfile, pool)
+
+      # parts are compressed while they are serialized
+      for tree in treesandfiles:
+          if tree != None:
+              #print 'Saving: '+treesandfiles[tree]    
+              part = self.open_part(docxfile, treesandfiles[tree], pool=pool)
+              try:
+                  if tree is self.document :
+                      write_xml_part(part, tree)
+                  else:
+                      part.write(etree.tostring(tree, xml_declaration=True, encoding='UTF-8', standalone='yes'))
+              finally:
+                  self.close_part(part)
+    finally:
+      if pool is not None :
+        pool.close()
+        pool.join()
     
+    docxfile.close()
     print 'Saved new file to: '+docxfilename
-    shutil.rmtree(self.template_dir)
     return
     
  ##################
@@ -848,19 +1508,21 @@ class DocxComposer:
     if block_level > 0 :
         ind = self.number_list_indent * block_level
 
-    # set paragraph tree
-    paragraph_tree = [['w:p'], 
+    # create paragraph from the prototype
+    paragraph = get_prototype('paragraph', lambda: [['w:p'], 
 		    	[['w:pPr'], 
-	    			[['w:pStyle',{'w:val':style}]],
-    				[['w:ind',{'w:leftChars':'0','w:left': str(ind)} ]]
+	    			[['w:pStyle',{'w:val':''}]],
+    				[['w:ind',{'w:leftChars':'0','w:left': ''} ]]
 	                ]
-		     ]
+		     ])
+    pPr = paragraph[0]
+    pPr[0].set(norm_name('w:val'), style)
+    pPr[1].set(norm_name('w:left'), str(ind))
 
     if self.breakbefore :
-        paragraph_tree.append( [['w:r'], [['w:lastRenderedPageBreak']]] )
+        paragraph.append(get_prototype('page_break',
+                         lambda: [['w:r'], [['w:lastRenderedPageBreak']]]))
 
-    # create paragraph
-    paragraph = make_element_tree(paragraph_tree)
     return paragraph
 
 #################
@@ -875,11 +1537,16 @@ class DocxComposer:
       paratext = paratext[0].splitlines()
       isliteralblock=True
 
-    paragraph = self.make_paragraph(style, block_level)
+    paragraph = None
+    if self.xml_backend == 'fast' and not isliteralblock :
+        paragraph = self.make_fast_paragraph(paratext, style, block_level)
+
+    if paragraph is None :
+      paragraph = self.make_paragraph(style, block_level)
 
-    #  Insert a text run
-    if paratext != None:
-        self.make_runs(paragraph, paratext, isliteralblock)
+      #  Insert a text run
+      if paratext != None:
+          self.make_runs(paragraph, paratext, isliteralblock)
 
     #  if the 'create_only' flag is True, append paragraph to the document
     if not create_only :
@@ -888,6 +1555,37 @@ class DocxComposer:
 
     return paragraph
 
+  def literal_block(self, runs, style='LiteralBlock', block_level=0, create_only=False):
+    '''
+      Make a new paragraph element which contains highlighted runs.
+      Return the paragraph element.
+    '''
+    paragraph = self.make_paragraph(style, block_level)
+
+    for run in runs:
+        paragraph.append(run)
+
+    if not create_only :
+        self.append(paragraph)
+        self.last_paragraph = paragraph
+
+    return paragraph
+
+  def math_block(self, omath, style='BodyText', block_level=0, number=None):
+    '''
+      Make a new paragraph element which contains display math (m:oMathPara).
+      Return the paragraph element.
+    '''
+    paragraph = self.make_paragraph(style, block_level)
+    paragraph.append(omath)
+    if number is not None :
+      paragraph.append(make_element_tree([['w:r'], [['w:tab']], [['w:t', '(%s)' % number]]]))
+
+    self.append(paragraph)
+    self.last_paragraph = paragraph
+
+    return paragraph
+
   def insert_linespace(self):
     self.append(self.make_paragraph())
 
@@ -913,24 +1611,36 @@ class DocxComposer:
       self.new_paragraph_style(style)
     style = self.stylenames.get(style, 'BodyText')
 
-    pPr = make_element_tree( [ ['w:pPr'], [['w:pStyle',{'w:val':style}]] ] )
+    pPr = get_prototype('paragraph_property',
+                        lambda: [ ['w:pPr'], [['w:pStyle',{'w:val':''}]] ])
+    pPr[0].set(norm_name('w:val'), style)
     paragraph.append(pPr) 
     return paragraph
 
+  def get_last_paragraphs(self, n=1):
+    '''
+       Get the last 'n' paragraphs of the current body (the last one comes first)
+    '''
+    result = []
+    for p in self.current_docbody.iterchildren(tag=norm_name('w:p'), reversed=True):
+      result.append(p)
+      if len(result) >= n : break
+    return result
+
   def get_last_paragraph(self):
-    paras = get_elements(self.current_docbody, 'w:p')
+    paras = self.get_last_paragraphs(2)
     if len(paras) > 1:
-      return paras[-1]
+      return paras[0]
     return None
 
   def trim_paragraph(self):
-    paras = get_elements(self.current_docbody, 'w:p')
-    if len(para) > 2:
-      self.last_paragraph = paras[-2]
-      self.current_docbody.remove(paras[-1])
-    elif len(para) > 1:
+    paras = self.get_last_paragraphs(3)
+    if len(paras) > 2:
+      self.last_paragraph = paras[1]
+      self.current_docbody.remove(paras[0])
+    elif len(paras) > 1:
       self.last_paragraph = None
-      self.current_docbody.remove(paras[-1])
+      self.current_docbody.remove(paras[0])
     return
 
   def get_paragraph_style(self, paragraph, force_create=False):
@@ -953,14 +1663,102 @@ class DocxComposer:
 
     return ind
 
+  def is_fast_text(self, targettext):
+    '''
+      Check if the 'fast' XML backend can make runs of 'targettext'
+    '''
+    if isinstance(targettext, basestring) :
+      return True
+    if not isinstance(targettext, list) :
+      return False
+    for x in targettext :
+      if isinstance(x, list) :
+        if not isinstance(x[0], basestring) or not isinstance(x[1], basestring) :
+          return False
+      elif not isinstance(x, basestring) :
+        return False
+    return True
+
+  def make_fast_runs(self, targettext):
+    '''
+      Make the markup of runs with text, which is the same as 'make_run'.
+    '''
+    if not isinstance(targettext, list) :
+      targettext = [targettext]
+    markup = []
+    for x in targettext :
+      if isinstance(x, list) :
+        txt, style = x[0], x[1]
+      else:
+        txt, style = x, 'Normal'
+
+      if txt == ':br' :
+        markup.append(fast_line_break)
+        continue
+
+      if txt.find(' ') != -1 :
+        t_start = '<w:t xml:space="preserve">'
+      else:
+        t_start = '<w:t>'
+
+      if style != 'Normal' :
+        if style not in self.stylenames :
+          self.new_character_style(style)
+        markup.extend(('<w:r><w:rPr><w:rStyle w:val="', escape_xml(style, True), '">',
+                       t_start, escape_xml(txt), '</w:t></w:rStyle></w:rPr></w:r>'))
+      else:
+        markup.extend(('<w:r>', t_start, escape_xml(txt), '</w:t></w:r>'))
+    return ''.join(markup)
+
+  def make_fast_paragraph(self, paratext, style='BodyText', block_level=0):
+    '''
+      Make a new paragraph element from its markup, which is the same as
+      'make_paragraph' and 'make_runs'. Return None if it can't be made.
+    '''
+    if paratext is not None and not self.is_fast_text(paratext) :
+      return None
+
+    if style not in self.stylenames :
+      self.new_paragraph_style(style)
+
+    ind = 0
+    if block_level > 0 :
+        ind = self.number_list_indent * block_level
+
+    markup = [fast_paragraph_start, '<w:pPr><w:pStyle w:val="', escape_xml(style, True),
+              '"/><w:ind w:leftChars="0" w:left="', str(ind), '"/></w:pPr>']
+    if self.breakbefore :
+      markup.append(fast_page_break)
+    if paratext is not None :
+      markup.append(self.make_fast_runs(paratext))
+    markup.append('</w:p>')
+
+    try:
+      return etree.fromstring(''.join(markup))
+    except etree.XMLSyntaxError:
+      return None
+
   def make_runs(self, paragraph, targettext, literal_block=False):
     '''
       Make new runs with text.
     '''
+    if self.xml_backend == 'fast' and not literal_block and self.is_fast_text(targettext) :
+      try:
+        runs = etree.fromstring(fast_paragraph_start + self.make_fast_runs(targettext) + '</w:p>')
+      except etree.XMLSyntaxError:
+        runs = None
+      if runs is not None :
+        for r in list(runs) :
+          paragraph.append(r)
+        return paragraph
+
     run = []
     if isinstance(targettext, (list)) :
         for i,x in enumerate(targettext) :
-            if isinstance(x, (list)) :
+            if etree.iselement(x) :
+                # inline math (m:oMath) is placed among runs
+                run.append(x)
+            elif isinstance(x, (list)) :
                 run.append(self.make_run(x[0], style=x[1]))
             else:
 	        if literal_block :
@@ -1111,20 +1909,20 @@ class DocxComposer:
        
     '''
     result =[]
-    for p in self.docbody :
-      elem = get_elements(p, 'w:pPr/w:numPr/w:numId')
-      for x in elem:
-        if int(x.attrib[norm_name('w:val')]) == int(nId) :
-          result.append(p)
+    for p in self.numbering_registry.get_paragraphs(nId) :
+      if p.getparent() is self.docbody :
+        result.append(p)
     return result
 
   def set_numbering_id(self, paragraph, nId):
     '''
        
     '''
-    elem = get_elements(paragraph, 'w:pPr/w:numPr/w:numId')
-    if elem :
-        elem[0].set(norm_name('w:val'), str(nId))
+    elem = paragraph.find(norm_path('w:pPr/w:numPr/w:numId'))
+    if elem is not None :
+        self.numbering_registry.remove_paragraph(elem.get(norm_name('w:val')), paragraph)
+        elem.set(norm_name('w:val'), str(nId))
+        self.numbering_registry.add_paragraph(nId, paragraph)
 
   def replace_numbering_id(self, oldId, newId):
     '''
@@ -1139,7 +1937,7 @@ class DocxComposer:
        Insert paragraph property element with style.
     '''
     style=self.get_paragraph_style(paragraph, force_create=True)
-    pPr = get_elements(paragraph, 'w:pPr')[0]
+    pPr = paragraph.find(norm_name('w:pPr'))
 
     ilvl = lvl 
     if style == 'ListNumber':
@@ -1153,17 +1951,18 @@ class DocxComposer:
         num_id = self.styleDocx.get_numbering_style_id(style)
     else :
       num_id = str(nId)
-      if num_id not in self.get_numbering_ids() :
+      if not self.numbering_registry.has_id(num_id) :
 
-	if enum_prefix : lvl_text=enum_prefix
+        if enum_prefix : lvl_text=enum_prefix
         newid = self.get_max_numbering_id()+1
-	if newid < nId : newid = nId
+        if newid < nId : newid = nId
         num_id = str(self.new_ListNumber_style(newid, start, lvl_text, enum_type))
 
     numPr_tree =[['w:numPr'], [['w:ilvl',{'w:val': str(ilvl)}]], [['w:numId',{'w:val': num_id}]] ]
     numPr = make_element_tree(numPr_tree)
 
     pPr.append(numPr)
+    self.numbering_registry.add_paragraph(num_id, paragraph)
 
     ind = self.get_numbering_indent(style, lvl, nId)
     self.set_indent(paragraph, ind)
@@ -1208,7 +2007,7 @@ class DocxComposer:
                    [['w:abstractNumId', {'w:val': orig_numid}] ],
 	  ]
     num = make_element_tree(num_tree)
-    self.numids.append(num)
+    self.numbering_registry.add_num(num)
     return
 
   def new_ListNumber_style(self, nId, start_val=1, lvl_txt='%1.', typ=None):
@@ -1245,25 +2044,30 @@ class DocxComposer:
     abstnum = make_element_tree(abstnum_tree)
     num = make_element_tree(num_tree)
     self.abstractNums.append(abstnum)
-    self.numids.append(num)
+    self.numbering_registry.add_num(num)
     return  newid
 
 ########## 
 ##      Create New Style
-  def new_character_style(self, styname):
+  def new_character_style(self, styname, rPr=None, styleid=None):
     '''
-       
+       Add a character style, 'rPr' is a 'w:rPr' element of its run properties
     '''
-    newstyle_tree = [['w:style', {'w:type':'character','w:customStye':'1', 'w:styleId': styname}],
+    if styleid is None :
+      styleid = styname
+    newstyle_tree = [['w:style', {'w:type':'character','w:customStye':'1', 'w:styleId': styleid}],
                          [['w:name', {'w:val': styname}]],
-                         [['w:basedOn', {'w:val': self.styleDocx.character_style_id}]],
-                         [['w:rPr'], [['w:color', {'w:val': 'FF0000'}]] ]
+                         [['w:basedOn', {'w:val': self.styleDocx.character_style_id}]]
                     ]
+    if rPr is None :
+      newstyle_tree.append([['w:rPr'], [['w:color', {'w:val': 'FF0000'}]] ])
 
     newstyle = make_element_tree(newstyle_tree)
+    if rPr is not None :
+      newstyle.append(rPr)
     self.styleDocx.styles.append(newstyle)
-    self.stylenames[styname] = styname
-    return styname
+    self.stylenames[styname] = styleid
+    return styleid
 
   def new_paragraph_style(self, styname):
     '''
@@ -1289,9 +2093,9 @@ class DocxComposer:
        
     '''
     try:
-      rows = get_elements(table, 'w:tr')
+      rows = table.findall(norm_name('w:tr'))
       if len(rows) > pos[1] :
-        return get_elements(rows[pos[1]], 'w:tc')[pos[0]]
+        return rows[pos[1]].findall(norm_name('w:tc'))[pos[0]]
       else :
         print  "Invalid position", pos
     except:
@@ -1307,9 +2111,9 @@ class DocxComposer:
       cell.append(paragraph)
     return cell
 
-  def create_table_row(self, n_cells, cellsize=None, contents=None, nline=0,firstCol=0):
+  def make_table_row(self, n_cells, cellsize=None, nline=0,firstCol=0):
     '''
-      Create table row
+      Make an empty table row element
     '''
     if nline < 0 :
       trPr_val = '100000000000'
@@ -1318,9 +2122,9 @@ class DocxComposer:
     else :
       trPr_val = '000000010000'
 
-    tr_tree = [['w:tr'], [['w:trPr'], [['w:cnfStyle', {'w:val':trPr_val}]] ] ]
-
-    row = make_element_tree(tr_tree)
+    row = get_prototype('table_row',
+                        lambda: [['w:tr'], [['w:trPr'], [['w:cnfStyle', {'w:val':''}]] ] ])
+    row[0][0].set(norm_name('w:val'), trPr_val)
 
     for i in range(n_cells):   
       i - firstCol
@@ -1331,97 +2135,119 @@ class DocxComposer:
       else :
         tcPr_val = '000001000000'
 
-      tc_tree = [['w:tc'], [['w:tcPr'], [['w:cnfStyle', {'w:val':tcPr_val}]] ] ]
-      cell = make_element_tree(tc_tree)
+      cell = get_prototype('table_cell',
+                           lambda: [['w:tc'], [['w:tcPr'], [['w:cnfStyle', {'w:val':''}]] ] ])
+      cell[0][0].set(norm_name('w:val'), tcPr_val)
       row.append(cell)
 
       # Properties
-      cellprops = get_elements(cell,'w:tcPr')[0]
+      cellprops = cell[0]
       if cellsize > 0:
-        cellwidth = make_element_tree([['w:tcW',{'w:w':str(cellsize[i]),'w:type':'dxa'}]])
+        cellwidth = get_prototype('table_cell_width',
+                                  lambda: [['w:tcW',{'w:w':'','w:type':'dxa'}]])
+        cellwidth.set(norm_name('w:w'), str(cellsize[i]))
         cellprops.append(cellwidth)
 
-      if contents :
-        cell.append(self.paragraph(contents[i], create_only=True))
+    return row
 
-      # Paragraph (Content)
+  def create_table_row(self, cursor, n_cells, cellsize=None, contents=None, nline=0,firstCol=0):
+    '''
+      Create table row, append it to the table and move the cursor to it.
+      Rows are cloned from a prototype which is made once per layout of the table.
+    '''
+    if nline < 0 :
+      rowtype = -1
+    else :
+      rowtype = nline % 2
+    if cellsize :
+      cellsize = tuple(cellsize)
 
-    return row
+    key = (n_cells, cellsize, rowtype, firstCol)
+    prototype = cursor.row_prototypes.get(key)
+    if prototype is None :
+      prototype = self.make_table_row(n_cells, cellsize, nline, firstCol)
+      cursor.row_prototypes[key] = prototype
+
+    row = copy.deepcopy(prototype)
+    cursor.add_row(row, row[1:])
+
+    # Paragraph (Content)
+    if contents :
+      for i in range(n_cells):
+        cursor.append_paragraph(self.paragraph(contents[i], create_only=True), i)
+
+    return cursor
 
   def create_table(self, colsize, tstyle='NormalTable'):
     '''
-      Create table
+      Create table, and return a cursor of it
     '''
     table_tree = [['w:tbl'],
-                  [['w:tblPr'], [['w:tblStyle',{'w:val':tstyle}]], [['w:tblW',{'w:w':'0','w:type':'auto'}]] ],
-		  ['w:tblGrid']
+                  [['w:tblPr'], [['w:tblStyle',{'w:val':tstyle}]], [['w:tblW',{'w:w':'0','w:type':'auto'}]] ]
                  ]
     table = make_element_tree(table_tree)
 
     # Table Grid    
-    tablegrid = get_elements(table,'w:tblGrid')[0]
+    tablegrid = make_element_tree(['w:tblGrid'])
     for csize in colsize:
         tablegrid.append(make_element_tree([['w:gridCol',{'w:w': str(csize)}]]))
+    table.append(tablegrid)
 
-    return table                 
+    return TableCursor(table)
 
 ##############
 ###### for reStructuredText (FieldList and Admonitions)
-  def get_last_field_list_body(self, table):
+  def get_last_field_list_body(self, cursor):
     '''
        
     '''
-    row = get_elements(table, 'w:tr')[-1]
-    return get_elements(row, 'w:tc')[1]
+    return cursor.cells[1]
 
-  def set_field_list_item(self, table, contents, n=0):
+  def set_field_list_item(self, cursor, contents, n=0):
     '''
        
     '''
-    row = get_elements(table, 'w:tr')[-1]
-    cell = get_elements(row, 'w:tc')[n]
+    cursor.get_cell(n)
     if isinstance(contents, str) :
-      cell.append(self.paragraph(contents, create_only=True))
+      cursor.append_paragraph(self.paragraph(contents, create_only=True))
     elif isinstance(contents, list) :
       for x in contents: 
-        cell.append(self.paragraph(x, create_only=True))
+        cursor.append_paragraph(self.paragraph(x, create_only=True))
     else :
       print "Invalid parameter:", contents
 
-  def insert_field_list_item(self, table, contents, n=0):
+  def insert_field_list_item(self, cursor, contents, n=0):
     '''
        
     '''
-    row = self.create_table_row(2, self.sizeof_field_list,firstCol=1)
-    table.append(row)
-    self.set_field_list_item(table, contents, n)
+    self.create_table_row(cursor, 2, self.sizeof_field_list,firstCol=1)
+    self.set_field_list_item(cursor, contents, n)
 
   def insert_field_list_table(self):
     '''
        
     '''
-    table = self.create_table(self.sizeof_field_list,tstyle='FieldList')
-    self.append(table)
-    return table
+    cursor = self.create_table(self.sizeof_field_list,tstyle='FieldList')
+    self.append(cursor.table)
+    return cursor
 
-  def insert_option_list_item(self, table, contents, nrow=0):
+  def insert_option_list_item(self, cursor, contents, nrow=0):
     '''
        
     '''
-    row = self.create_table_row(1, [self.max_table_width - 500], nline=nrow )
-    table.append(row)
-    cell = get_elements(row, 'w:tc')[0]
+    self.create_table_row(cursor, 1, [self.max_table_width - 500], nline=nrow )
+    cursor.get_cell(0)
     if isinstance(contents, str) :
       paragraph = self.paragraph(contents, create_only=True)
       if nrow == 0:
         self.set_indent(paragraph, self.number_list_indent)
-      cell.append(paragraph0r)
+      cursor.append_paragraph(paragraph)
     elif isinstance(contents, list) :
       for x in contents: 
         paragraph = self.paragraph(x, create_only=True)
         if nrow == 0:
           self.set_indent(paragraph, self.number_list_indent)
-        cell.append(paragraph)
+        cursor.append_paragraph(paragraph)
     else :
       print "Invalid parameter:", contents
 
@@ -1429,28 +2255,50 @@ class DocxComposer:
     '''
        
     '''
-    table = self.create_table([self.max_table_width -500],tstyle='OptionList')
-    self.append(table)
-    return table
+    cursor = self.create_table([self.max_table_width -500],tstyle='OptionList')
+    self.append(cursor.table)
+    return cursor
 
   def insert_admonition_table(self, contents, title='Note: ', tstyle='NoteAdmonition'):
     '''
        
     '''
-    table = self.create_table([self.max_table_width-1000], tstyle=tstyle)
-    for i in range(2) :
-      row = self.create_table_row(1, nline=i-1)
-      table.append(row)
-    
-    self.append_paragrap_to_table_cell(table, self.paragraph(title, create_only=True) , [0,0])
+    cursor = self.create_table([self.max_table_width-1000], tstyle=tstyle)
 
-    self.append(table)
+    self.create_table_row(cursor, 1, nline=-1)
+    cursor.append_paragraph(self.paragraph(title, create_only=True), 0)
+    self.create_table_row(cursor, 1, nline=0)
+
+    self.append(cursor.table)
     self.insert_linespace()
 
-    return self.get_table_cell(table, [0,1])
+    return cursor.get_cell(0)
 
 ##############
 ######  Support a simple table only
+  def begin_table(self, colsize, tstyle='rstTable'):
+    '''
+      Append an empty table to the document, and return a cursor of it.
+      Rows are appended one by one with 'append_table_row'.
+    '''
+    sizeof_table = 0
+    for n in colsize :
+       sizeof_table += n
+
+    colsize[-1] += self.max_table_width - sizeof_table
+
+    cursor = self.create_table(colsize, tstyle=tstyle)
+    cursor.colsize = colsize
+
+    self.append(cursor.table)
+    return cursor
+
+  def append_table_row(self, cursor, contents):
+    '''
+      Append a row which contains 'contents' to the table started by 'begin_table'
+    '''
+    return self.create_table_row(cursor, len(cursor.colsize), cursor.colsize, contents, cursor.nrows-1)
+
   def table(self, contents, colsize=None, tstyle='rstTable'):
     '''
       Get a list of lists, return a table
@@ -1459,49 +2307,32 @@ class DocxComposer:
     columns = len(contents[0])    
 
     if colsize is None : 
-        for i in range(columns):
-            colsize[i] = 2400
-    sizeof_table = 0
-    for n in colsize :
-       sizeof_table += n
+        colsize = [2400] * columns
 
-    colsize[-1] += self.max_table_width - sizeof_table
+    cursor = self.begin_table(colsize, tstyle=tstyle)
 
-    table = self.create_table(colsize, tstyle=tstyle)
+    for x in contents :
+      self.append_table_row(cursor, x)
 
-    for i,x in enumerate(contents) :
-      row = self.create_table_row(columns, colsize, x, i-1)
-      table.append(row)            
-
-    self.append(table)
-    return table                 
+    return cursor.table
 
   def picture(self, picname, picdescription, pixelwidth=None,
-            pixelheight=None, nochangeaspect=True, nochangearrowheads=True, align='center'):
+            pixelheight=None, nochangeaspect=True, nochangearrowheads=True, align='center',
+            link=None):
     '''
       Take a relationshiplist, picture file name, and return a paragraph containing the image
       and an updated relationshiplist
+      If 'link' is given, the image is not embedded, but referred by the external link.
       
       This function is copied from 'python-docx' library
     '''
     # http://openxmldeveloper.org/articles/462.aspx
     # Create an image. Size may be specified, otherwise it will based on the
     # pixel size of image. Return a paragraph containing the picture'''  
-    # Copy the file into the media dir
-    media_dir = join(self.template_dir,'word','media')
-    if not os.path.isdir(media_dir):
-        os.mkdir(media_dir)
 #    picpath, picname = os.path.abspath(picname), os.path.basename(picname)
 
     picpath, picname = os.path.abspath(picname), os.path.basename(picname)
     picext = os.path.splitext(picname)
-    self.images += 1
-    if (picext[1] == '.jpg') :
-      picname = 'image'+str(self.images)+'.jpeg'
-    else:
-      picname = 'image'+str(self.images)+picext[1]
-
-    shutil.copyfile(picpath, join(media_dir,picname))
     relationshiplist = self.relationships
 
     # Check if the user has specified a size
@@ -1509,57 +2340,107 @@ class DocxComposer:
         # If not, get info from the picture itself
         pixelwidth,pixelheight = Image.open(picpath).size[0:2]
 
+    # The same image is stored once, and referred with the same relationship ID
+    if link is not None :
+      picrelid = self.media_links.get(link)
+      if picrelid is None :
+        picrelid = 'rId'+str(len(relationshiplist)+1)
+        relationshiplist.append([
+            'http://schemas.openxmlformats.org/officeDocument/2006/relationships/image',
+            link, 'External'])
+        self.media_links[link] = picrelid
+    else:
+      digest = self.get_media_digest(picpath)
+      if digest in self.media_parts :
+        picrelid, media = self.media_parts[digest]
+        picname = media[0]
+        media[3] = max(media[3], pixelwidth)
+        media[4] = max(media[4], pixelheight)
+        self.media_reused += 1
+        self.media_saved_bytes += os.path.getsize(picpath)
+      else:
+        self.images += 1
+        if (picext[1] == '.jpg') :
+          picname = 'image'+str(self.images)+'.jpeg'
+        else:
+          picname = 'image'+str(self.images)+picext[1]
+
+        # Set relationship ID to the first available  
+        picrelid = 'rId'+str(len(relationshiplist)+1)
+        relationship = [
+            'http://schemas.openxmlformats.org/officeDocument/2006/relationships/image',
+            'media/'+picname]
+        relationshiplist.append(relationship)
+
+        # The file is written into the package when the document is saved
+        media = [picname, picpath, relationship, pixelwidth, pixelheight]
+        self.media_files.append(media)
+        self.media_parts[digest] = (picrelid, media)
+        self.media_bytes += os.path.getsize(picpath)
+
     # OpenXML measures on-screen objects in English Metric Units
     # 1cm = 36000 EMUs            
     emuperpixel = 12667
     width = str(pixelwidth * emuperpixel)
     height = str(pixelheight * emuperpixel)   
     
-    # Set relationship ID to the first available  
     picid = '2'    
-    picrelid = 'rId'+str(len(relationshiplist)+1)
-    relationshiplist.append([
-        'http://schemas.openxmlformats.org/officeDocument/2006/relationships/image',
-        'media/'+picname])
+    if link is not None :
+      blip_attr = 'r:link'
+    else:
+      blip_attr = 'r:embed'
     
-    # There are 3 main elements inside a picture
-    pic_tree = [['pic:pic'],
-                   [['pic:nvPicPr'],  # The non visual picture properties 
-                       [['pic:cNvPr', {'id':'0','name':'Picture 1','descr':picname}]],
-                       [['pic:cNvPicPr'], [ ['a:picLocks', {'noChangeAspect':str(int(nochangeaspect)), 'noChangeArrowheads':str(int(nochangearrowheads))} ] ] ]
-                   ],
-                   [['pic:blipFill'],  # The Blipfill - specifies how the image fills the picture area (stretch, tile, etc.)
-                     [['a:blip',{'r:embed':picrelid}]],
-                     [['a:srcRect']],
-		     [['a:stretch'],[['a:fillRect']]]
-		   ],
-                   [['pic:spPr',{'bwMode':'auto'}],  #  The Shape properties
-		     [['a:xfrm'],[['a:off',{'x':'0','y':'0'} ]], [['a:ext',{'cx':width,'cy':height}]]],
-		     [['a:prstGeom',{'prst':'rect'}], ['a:avLst']],
-		     [['a:noFill']]
-		   ]
-	       ]
-
-    graphic_tree = [['a:graphic'],
-                      [['a:graphicData', {'uri':'http://schemas.openxmlformats.org/drawingml/2006/picture'}], pic_tree ]
-
-		      ]
-
-    inline_tree = [['wp:inline',{'distT':"0",'distB':"0",'distL':"0",'distR':"0"}],
-                       [['wp:extent',{'cx':width,'cy':height}]],
-                       [['wp:effectExtent', {'l':'25400','t':'0','r':'0','b':'0'}]],
-                       [['wp:docPr', {'id':picid,'name':'Picture 1','descr':picdescription}]], 
-                       [['wp:cNvGraphicFramePr'], [['a:graphicFrameLocks',{'noChangeAspect':'1'} ]]],
-		       graphic_tree
-		       ]
-
-    paragraph_tree = [['w:p'],
-                         [['w:pPr'], [['w:jc', {'w:val':align}]]],
-			 [['w:r'], [['w:rPr'], [['w:noProof']]], [['w:drawing'], inline_tree] ]
-			 ]
-
-
-    paragraph = make_element_tree(paragraph_tree)
+    # The drawing scaffolding is made once for each kind of the picture,
+    # and only the variable attributes are filled in.
+    def make_tree():
+      # There are 3 main elements inside a picture
+      pic_tree = [['pic:pic'],
+                     [['pic:nvPicPr'],  # The non visual picture properties 
+                         [['pic:cNvPr', {'id':'0','name':'Picture 1','descr':''}]],
+                         [['pic:cNvPicPr'], [ ['a:picLocks', {'noChangeAspect':str(int(nochangeaspect)), 'noChangeArrowheads':str(int(nochangearrowheads))} ] ] ]
+                     ],
+                     [['pic:blipFill'],  # The Blipfill - specifies how the image fills the picture area (stretch, tile, etc.)
+                       [['a:blip',{blip_attr:''}]],
+                       [['a:srcRect']],
+  		     [['a:stretch'],[['a:fillRect']]]
+  		   ],
+                     [['pic:spPr',{'bwMode':'auto'}],  #  The Shape properties
+  		     [['a:xfrm'],[['a:off',{'x':'0','y':'0'} ]], [['a:ext',{'cx':'','cy':''}]]],
+  		     [['a:prstGeom',{'prst':'rect'}], ['a:avLst']],
+  		     [['a:noFill']]
+  		   ]
+  	       ]
+
+      graphic_tree = [['a:graphic'],
+                        [['a:graphicData', {'uri':'http://schemas.openxmlformats.org/drawingml/2006/picture'}], pic_tree ]
+
+  		      ]
+
+      inline_tree = [['wp:inline',{'distT':"0",'distB':"0",'distL':"0",'distR':"0"}],
+                         [['wp:extent',{'cx':'','cy':''}]],
+                         [['wp:effectExtent', {'l':'25400','t':'0','r':'0','b':'0'}]],
+                         [['wp:docPr', {'id':picid,'name':'Picture 1','descr':''}]], 
+                         [['wp:cNvGraphicFramePr'], [['a:graphicFrameLocks',{'noChangeAspect':'1'} ]]],
+  		       graphic_tree
+  		       ]
+
+      paragraph_tree = [['w:p'],
+                           [['w:pPr'], [['w:jc', {'w:val':align}]]],
+  			 [['w:r'], [['w:rPr'], [['w:noProof']]], [['w:drawing'], inline_tree] ]
+  			 ]
+      return paragraph_tree
+
+    key = ('picture', blip_attr, align, nochangeaspect, nochangearrowheads)
+    paragraph = get_prototype(key, make_tree)
+    inline = paragraph[1][1][0]
+    inline[0].set('cx', width)
+    inline[0].set('cy', height)
+    inline[2].set('descr', picdescription)
+    pic = inline[4][0][0]
+    pic[0][0].set('descr', picname)
+    pic[1][0].set(norm_name(blip_attr), picrelid)
+    pic[2][0][1].set('cx', width)
+    pic[2][0][1].set('cy', height)
     self.relationships = relationshiplist
     self.append(paragraph)
 
@@ -1567,21 +2448,98 @@ class DocxComposer:
     return paragraph
 
 
+  def set_media_file(self, media, path, ext=None):
+    '''
+       Replace the file of a media part, and change its extension if 'ext' is given
+    '''
+    media[1] = path
+    if ext is not None :
+      media[0] = os.path.splitext(media[0])[0] + ext
+      media[2][1] = 'media/' + media[0]
+
+  def get_media_archive_names(self):
+    return [ 'word/media/' + media[0] for media in self.media_files ]
+
+  def write_media(self, docxfile, pool=None):
+    '''
+       Write image files into the package from their sources.
+       Already compressed formats are stored without compression.
+    '''
+    for media in self.media_files :
+      if os.path.splitext(media[0])[1].lower() in stored_media_extensions :
+        compress_type = zipfile.ZIP_STORED
+      else:
+        compress_type = None
+      part = self.open_part(docxfile, 'word/media/' + media[0], compress_type, pool)
+      try:
+        f = open(media[1], 'rb')
+        try:
+          for data in iter(lambda: f.read(deflate_chunk_size), ''):
+            part.write(data)
+        finally:
+          f.close()
+      finally:
+        self.close_part(part)
+
+  def recompress_part(self, docxfile, zinfo, pool=None):
+    '''
+       Copy a part of the style file, compressed with 'docx_compression'
+    '''
+    compress_type = None
+    if os.path.splitext(zinfo.filename)[1].lower() in stored_media_extensions :
+      compress_type = zipfile.ZIP_STORED
+    part = self.open_part(docxfile, zinfo.filename, compress_type, pool)
+    try:
+      part.write(self.styleDocx.docx.read(zinfo))
+    finally:
+      self.close_part(part)
+
+  def open_part(self, docxfile, arcname, compress_type=None, pool=None):
+    '''
+       Open a part of the package to write, with 'docx_compression'
+    '''
+    default_type, level = compression_modes[self.compression]
+    if compress_type is None :
+      compress_type = default_type
+    return ZipPartWriter(docxfile, arcname, compress_type, level, pool,
+                         2 * self.compression_pool_size)
+
+  def close_part(self, part):
+    part.close()
+    self.compression_time += part.compress_time
+    self.compression_wait += part.wait_time
+    self.compression_bytes_in += part.zinfo.file_size
+    self.compression_bytes_out += part.zinfo.compress_size
+
+  def get_compression_summary(self):
+    return '%s, %d bytes to %d bytes, %.3fs deflating, %.3fs waiting with %d threads' % (
+            self.compression, self.compression_bytes_in, self.compression_bytes_out,
+            self.compression_time, self.compression_wait, self.compression_pool_size)
+
+  def get_media_digest(self, picpath):
+    '''
+       Get the content digest of an image file
+    '''
+    digest = self.media_digests.get(picpath)
+    if digest is None :
+      sha = hashlib.sha1()
+      f = open(picpath, 'rb')
+      try:
+        for data in iter(lambda: f.read(65536), ''):
+          sha.update(data)
+      finally:
+        f.close()
+      digest = self.media_digests[picpath] = sha.hexdigest()
+    return digest
+
   def contenttypes(self):
     '''
        create [Content_Types].xml 
        This function copied from 'python-docx' library
     '''
-    prev_dir = os.getcwd() # save previous working dir
-    os.chdir(self.template_dir)
-
-    filename = '[Content_Types].xml'
-    if not os.path.exists(filename):
-        raise RuntimeError('You need %r file in template' % filename)
-
     parts = dict([
         (x.attrib['PartName'], x.attrib['ContentType'])
-        for x in etree.fromstring(open(filename).read()).xpath('*')
+        for x in etree.fromstring(self.styleDocx.read_part('[Content_Types].xml')).xpath('*')
         if 'PartName' in x.attrib
     ])
 
@@ -1602,7 +2560,6 @@ class DocxComposer:
       types_tree.append([['Default',{'Extension':extension,'ContentType':filetypes[extension]}]])
 
     types = make_element_tree(types_tree, nsprefixes['ct'])
-    os.chdir(prev_dir)
     self._contenttypes = types
     return types
 
@@ -1677,21 +2634,14 @@ class DocxComposer:
     return web
 
   def relationshiplist(self):
-    prev_dir = os.getcwd() # save previous working dir
-    os.chdir(self.template_dir)
-
-    filename = 'word/_rels/document.xml.rels'
-    if not os.path.exists(filename):
-        raise RuntimeError('You need %r file in template' % filename)
-
-    relationships = etree.fromstring(open(filename).read())
+    relationships = etree.fromstring(self.styleDocx.read_part('word/_rels/document.xml.rels'))
+    # [type, target] or [type, target, target mode]
     relationshiplist = [
-            [x.attrib['Type'], x.attrib['Target']]
+            [x.attrib['Type'], x.attrib['Target']] +
+            [ x.attrib[k] for k in ('TargetMode',) if k in x.attrib ]
             for x in relationships.xpath('*')
     ]
 
-    os.chdir(prev_dir)
-
     return relationshiplist
 
   def wordrelationships(self):
@@ -1704,7 +2654,10 @@ class DocxComposer:
     count = 0
     for relationship in self.relationships:
         # Relationship IDs (rId) start at 1.
-	rel_tree.append([['Relationship',{'Id':'rId'+str(count+1), 'Type':relationship[0],'Target':relationship[1]}]])
+        attrs = {'Id':'rId'+str(count+1), 'Type':relationship[0],'Target':relationship[1]}
+        if len(relationship) > 2 :
+            attrs['TargetMode'] = relationship[2]
+	rel_tree.append([['Relationship', attrs]])
         count += 1
 
     relationships = make_element_tree(rel_tree, nsprefixes['pr'])
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinx-docxbuilder dotrender
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Render graphviz diagrams with a timeout, and keep the rendered
+    images between builds.
+
+    :license: MIT, see LICENSE for details.
+"""
+
+import os
+import posixpath
+import threading
+from hashlib import sha1
+from subprocess import Popen, PIPE
+
+from sphinx.ext.graphviz import GraphvizError
+from sphinx.util.osutil import ensuredir
+
+from cache import make_key, sorted_items
+
+
+class DotTimeout(GraphvizError):
+    pass
+
+# dot command -> version string
+_dot_versions = {}
+_dot_versions_lock = threading.Lock()
+
+def get_dot_version(dot):
+    '''
+       Get the version string which 'dot -V' prints, or None
+    '''
+    _dot_versions_lock.acquire()
+    try:
+        if dot not in _dot_versions:
+            try:
+                p = Popen([dot, '-V'], stdout=PIPE, stderr=PIPE)
+                stdout, stderr = p.communicate()
+                _dot_versions[dot] = (stderr or stdout).strip()
+            except OSError:
+                _dot_versions[dot] = None
+        return _dot_versions[dot]
+    finally:
+        _dot_versions_lock.release()
+
+def run_dot(args, code, cwd=None, timeout=None):
+    '''
+       Run dot, and return (returncode, stdout, stderr).
+       The process is killed after 'timeout' seconds.
+    '''
+    p = Popen(args, stdout=PIPE, stdin=PIPE, stderr=PIPE, cwd=cwd)
+    timer = None
+    expired = []
+    if timeout:
+        def kill():
+            expired.append(True)
+            try:
+                p.kill()
+            except OSError:
+                pass
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+    try:
+        try:
+            stdout, stderr = p.communicate(code)
+        except (OSError, IOError):
+            # dot may close the standard input when an error occurs
+            stdout, stderr = p.stdout.read(), p.stderr.read()
+            p.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+    if expired:
+        raise DotTimeout('dot did not finish in %s seconds' % timeout)
+    return p.returncode, stdout, stderr
+
+#
+#  DotRenderer class
+#   Rendered images are written in the image directory of the builder with
+#   the same names as graphviz.render_dot, and kept in a content cache by
+#   (code, options, dot version, arguments, format).
+#
+class DotRenderer:
+    def __init__(self, builder, cache=None, timeout=None):
+        self.builder = builder
+        self.cache = cache
+        self.timeout = timeout
+        # the counters are updated from the threads of the pre-pass
+        self.counter_lock = threading.Lock()
+        self.rendered = 0
+        self.reused = 0
+        self.timeouts = 0
+
+    def count(self, name):
+        '''
+           Increment a counter of the statistics
+        '''
+        self.counter_lock.acquire()
+        try:
+            setattr(self, name, getattr(self, name) + 1)
+        finally:
+            self.counter_lock.release()
+
+    def get_output_path(self, code, options, format, prefix='graphviz'):
+        config = self.builder.config
+        graphviz_dot = options.get('graphviz_dot', config.graphviz_dot)
+        hashkey = (code + str(options) + str(graphviz_dot) +
+                   str(config.graphviz_dot_args)).encode('utf-8')
+        fname = '%s-%s.%s' % (prefix, sha1(hashkey).hexdigest(), format)
+        return (posixpath.join(self.builder.imgpath, fname),
+                os.path.join(self.builder.outdir, self.builder.imagedir, fname))
+
+    def render(self, code, options, format='png'):
+        '''
+           Render a diagram, and return (relative name, output file name)
+        '''
+        config = self.builder.config
+        relfn, outfn = self.get_output_path(code, options, format)
+        if os.path.isfile(outfn):
+            self.count('reused')
+            return relfn, outfn
+
+        graphviz_dot = options.get('graphviz_dot', config.graphviz_dot)
+        data = None
+        if self.cache is not None:
+            key = make_key('graphviz', code, sorted_items(options), graphviz_dot,
+                           get_dot_version(graphviz_dot), config.graphviz_dot_args, format)
+            data = self.cache.get(key)
+
+        if data is None:
+            # graphviz expects UTF-8 by default
+            if isinstance(code, unicode):
+                code = code.encode('utf-8')
+            dot_args = [graphviz_dot] + list(config.graphviz_dot_args) + ['-T' + format]
+            docname = options.get('docname', 'index')
+            cwd = os.path.dirname(os.path.join(self.builder.srcdir, docname))
+            try:
+                returncode, data, stderr = run_dot(dot_args, code, cwd, self.timeout)
+            except DotTimeout:
+                self.count('timeouts')
+                raise
+            except OSError, err:
+                raise GraphvizError('dot command %r cannot be run: %s' % (graphviz_dot, err))
+            if returncode != 0 or not data:
+                raise GraphvizError('dot exited with error:\n[stderr]\n%s\n'
+                                    '[stdout]\n%s' % (stderr, data))
+            self.count('rendered')
+            if self.cache is not None:
+                self.cache.put(key, data)
+        else:
+            self.count('reused')
+
+        # the same diagram may be rendered in other threads
+        ensuredir(os.path.dirname(outfn))
+        tmpname = '%s.%d-%d' % (outfn, os.getpid(), threading.current_thread().ident)
+        f = open(tmpname, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(tmpname, outfn)
+        return relfn, outfn
+
+    def summary(self):
+        return '%d rendered, %d reused, %d timed out' % (self.rendered, self.reused, self.timeouts)
@@ -1,23 +1,140 @@
 
+import copy
+import time
+import doctest
+
 from sphinx import highlighting
 from sphinx.highlighting import PygmentsBridge
+from sphinx.util import logging
 
+import pygments
 from pygments.formatter import Formatter
 from pygments.formatters import *
+from pygments.formatters.html import _get_ttype_class
+from pygments.lexers import PythonConsoleLexer, guess_lexer, get_lexer_by_name
+from pygments.filters import ErrorToken
+from pygments.token import Token
+from pygments.util import ClassNotFound, get_bool_opt
+
+from lxml import etree
+
+from cache import make_key, sorted_items
+
+logger = logging.getLogger(__name__)
+
+wordml_ns = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+wordml_nsmap = {'w': wordml_ns}
+xml_space = '{http://www.w3.org/XML/1998/namespace}space'
+
+# bump this when the runs made by DocxRunFormatter change
+run_format_version = '1'
+
+# languages of literal blocks are guessed from this many characters
+guess_sample_size = 4096
+guess_memo_size = 256
+# runs of tokens up to this length are cloned from prototypes,
+# and up to this number of prototypes are kept for a pygments style
+run_prototype_length = 64
+run_prototype_limit = 8192
+
+def is_streamed_block(source, stream_size, max_lines):
+    '''
+       Huge literal blocks, and blocks longer than the line cap, are
+       highlighted from the token stream, and neither prepared nor cached
+    '''
+    if stream_size and len(source) > stream_size:
+        return True
+    return bool(max_lines) and source.count('\n') >= max_lines
+
+def w_tag(name):
+    return '{%s}%s' % (wordml_ns, name)
+
+rstyle_path = '%s/%s' % (w_tag('rPr'), w_tag('rStyle'))
+
+def preprocess_source(source, lexer):
+    '''
+       Preprocess a source in the same way as Lexer.get_tokens
+       (newlines, stripping, tabs and the last newline)
+    '''
+    if source.startswith(u'\ufeff'):
+        source = source[1:]
+    source = source.replace('\r\n', '\n').replace('\r', '\n')
+    if lexer.stripall:
+        source = source.strip()
+    elif lexer.stripnl:
+        source = source.strip('\n')
+    if lexer.tabsize > 0:
+        source = source.expandtabs(lexer.tabsize)
+    if lexer.ensurenl and not source.endswith('\n'):
+        source += '\n'
+    return source
+
+def highlight_cache_key(source, lang, stylename, trim_doctest_flags, highlight_args,
+                        linenos=1, token_styles=False, style_ids=None):
+    '''
+       Make a cache key of highlighted runs of a literal block
+    '''
+    parts = ['highlight', run_format_version, pygments.__version__,
+             source, lang, stylename, trim_doctest_flags, linenos,
+             sorted_items(highlight_args), bool(token_styles)]
+    if token_styles and style_ids:
+        parts.append(sorted_items(style_ids))
+    return make_key(*parts)
+
+def token_style_id(ttype):
+    '''
+       Character style id of a token type. It is as short as the CSS class
+       of the HTML formatter (e.g. 'Pykc'), since every run refers it.
+    '''
+    return 'Py' + _get_ttype_class(ttype)
+
+def token_style_name(ttype):
+    '''
+       Character style name of a token type, e.g. 'Pygments Keyword Constant'
+    '''
+    return ' '.join(('Pygments',) + (tuple(ttype) or ('Token',)))
+
+def runs_to_fragment(runs):
+    '''
+       Serialize runs to store them in a cache
+    '''
+    p = etree.Element(w_tag('p'), nsmap=wordml_nsmap)
+    for run in runs:
+        p.append(run)
+    return etree.tostring(p, encoding='UTF-8')
+
+def fragment_to_runs(data):
+    '''
+       Restore runs from a serialized fragment
+    '''
+    return list(etree.fromstring(data))
+
+# pygments style -> color mapping of DocxFormatter
+_color_mappings = {}
+# (pygments style, style ids) -> {token type: run properties}, shared by all DocxRunFormatters
+_run_property_tables = {}
+# (pygments style, style ids) -> {(token type, text, token_styles): 'w:r' element}
+_run_prototypes = {}
 
 #--- Formatter
 class DocxFormatter(RtfFormatter):
   def __init__(self, **options):
         RtfFormatter.__init__(self, **options)
-        self.color_mapping = {}
+        self.color_mapping = _color_mappings.get(self.style)
+        if self.color_mapping is None:
+            self.color_mapping = _color_mappings[self.style] = self.make_color_mapping()
+
+  def make_color_mapping(self):
+        color_mapping = {}
         for _, style in self.style:
             for color in style['color'], style['bgcolor'], style['border']:
-                if color and color not in self.color_mapping:
-                    self.color_mapping[color] = r'%x%x%x' % (
+                if color and color not in color_mapping:
+                    color_mapping[color] = r'%x%x%x' % (
                         int(color[0:2], 16),
                         int(color[2:4], 16),
                         int(color[4:6], 16)
                     )
+        return color_mapping
 
   def format_unencoded(self, tokensource, outfile):
         for ttype, value in tokensource:
@@ -60,12 +177,338 @@ class DocxFormatter(RtfFormatter):
 	    outfile.write(r'</w:r>')
 
 
+#--- Formatter which builds elements
+class DocxRunFormatter(DocxFormatter):
+  '''
+     Build 'w:r' elements from the token stream directly,
+     instead of writing WordprocessingML as a string.
+     With the 'token_styles' option, runs refer character styles
+     named by token_style_id instead of having inline properties.
+     The 'style_ids' option maps token_style_id to the id of a style
+     of the template, which has the same name.
+  '''
+  def __init__(self, **options):
+        DocxFormatter.__init__(self, **options)
+        self.token_styles = get_bool_opt(options, 'token_styles', False)
+        self.style_ids = options.get('style_ids') or {}
+        table_key = (self.style, tuple(sorted_items(self.style_ids)))
+        self.property_table = _run_property_tables.setdefault(table_key, {})
+        self.run_prototypes = _run_prototypes.setdefault(table_key, {})
+
+  def format_unencoded(self, tokensource, outfile):
+        self.runs = list(self.iter_runs(tokensource))
+
+  def get_styled_token(self, ttype):
+        '''
+           The nearest token type which has a style entry
+        '''
+        while not self.style.styles_token(ttype) and ttype.parent:
+            ttype = ttype.parent
+        return ttype
+
+  def get_property_entry(self, ttype):
+        entry = self.property_table.get(ttype)
+        if entry is None:
+            entry = self.property_table[ttype] = self.make_property_entry(ttype)
+        return entry
+
+  def make_run_property(self, ttype):
+        rPr = self.get_property_entry(ttype)[self.token_styles and 1 or 0]
+        if rPr is None:
+            return None
+        return copy.deepcopy(rPr)
+
+  def make_property_entry(self, ttype):
+        '''
+           Make an entry of the run property table of the style, which is
+           (inline 'w:rPr', 'w:rPr' referring the token style) of a token type.
+           Token types without a style entry share the entry of their parent.
+        '''
+        styled = self.get_styled_token(ttype)
+        if styled is not ttype:
+            return self.get_property_entry(styled)
+
+        inline = self.make_inline_property(styled)
+        if inline is None:
+            return None, None
+        styleid = token_style_id(styled)
+        ref = etree.Element(w_tag('rPr'), nsmap=wordml_nsmap)
+        etree.SubElement(ref, w_tag('rStyle')).set(w_tag('val'), self.style_ids.get(styleid, styleid))
+        return inline, ref
+
+  def make_inline_property(self, ttype):
+        style = self.style.style_for_token(ttype)
+
+        rPr = etree.Element(w_tag('rPr'), nsmap=wordml_nsmap)
+        if style['bgcolor']:
+            etree.SubElement(rPr, w_tag('shd')).set(w_tag('themeFill'), self.color_mapping[style['bgcolor']])
+        if style['color']:
+            etree.SubElement(rPr, w_tag('color')).set(w_tag('val'), self.color_mapping[style['color']])
+        if style['bold']:
+            etree.SubElement(rPr, w_tag('b'))
+        if style['italic']:
+            etree.SubElement(rPr, w_tag('i'))
+        if style['underline']:
+            etree.SubElement(rPr, w_tag('u'))
+        if style['border']:
+            bdr = etree.SubElement(rPr, w_tag('bdr'))
+            bdr.set(w_tag('val'), 'single')
+            bdr.set(w_tag('space'), '0')
+            bdr.set(w_tag('color'), self.color_mapping[style['border']])
+
+        if len(rPr) == 0:
+            return None
+        return rPr
+
+  def make_run(self, ttype, value):
+        '''
+           Clone the run of a token which appeared before. Every run needs
+           its own elements in the tree, so a token costs a single deepcopy
+           instead of building the run and copying its properties.
+        '''
+        if len(value) > run_prototype_length:
+            return self.build_run(ttype, value)
+        key = (ttype, value, self.token_styles)
+        run = self.run_prototypes.get(key)
+        if run is None:
+            if len(self.run_prototypes) >= run_prototype_limit:
+                self.run_prototypes.clear()
+            run = self.run_prototypes[key] = self.build_run(ttype, value)
+        return copy.deepcopy(run)
+
+  def build_run(self, ttype, value):
+        run = etree.Element(w_tag('r'), nsmap=wordml_nsmap)
+        if value == '\n':
+            etree.SubElement(run, w_tag('br'))
+            return run
+
+        rPr = self.make_run_property(ttype)
+        if rPr is not None:
+            run.append(rPr)
+        vals = value.split('\n')
+        for i,txt in enumerate(vals) :
+            t = etree.SubElement(run, w_tag('t'))
+            if txt.find(' ') != -1 :
+                t.set(xml_space, 'preserve')
+            t.text = txt
+            if i < len(vals) - 1 :
+                etree.SubElement(run, w_tag('br'))
+        return run
+
+  def iter_runs(self, tokensource):
+        '''
+           Generate runs, the newline at the end of the block is dropped
+        '''
+        pending = None
+        for token in tokensource:
+            if pending is not None:
+                yield self.make_run(*pending)
+            pending = token
+
+        if pending is not None:
+            ttype, value = pending
+            if value.endswith('\n'):
+                value = value[:-1]
+            if value:
+                yield self.make_run(ttype, value)
+
 
 #--- PygmentsBridge
 class DocxPygmentsBridge(PygmentsBridge) :
    def __init__(self, dest='docx', stylename='sphinx',
-                 trim_doctest_flags=False):
+                 trim_doctest_flags=False, token_styles=False):
     PygmentsBridge.__init__(self, dest, stylename, trim_doctest_flags)
     dest = "html"
     self.formatter = DocxFormatter
+    self.run_formatter = DocxRunFormatter
+    self.token_styles = token_styles
+    # token style id -> id of the style of the template which has the same name
+    self.style_ids = {}
+    # style id -> bytes saved by a run which refers the style
+    self.token_style_savings = {}
+    # head of a literal block -> guessed lexer, for the current source document
+    self.guess_memo = {}
+    self.unknown_langs = set()
+    self.guessed_blocks = 0
+    self.guess_time = 0.0
+    self.streamed_blocks = 0
+    self.plain_lines = 0
+
+   def get_lexer(self, source, lang, opts=None):
+    '''
+       Find out which lexer to use, in the same way as highlight_block
+    '''
+    lexers = highlighting.lexers
+    if lang in ('py', 'python'):
+        if source.startswith('>>>'):
+            return lexers['pycon']
+        return lexers['python']
+    elif lang in ('py3', 'python3', 'default'):
+        if source.startswith('>>>'):
+            return lexers['pycon3']
+        return lexers['python3']
+    elif lang == 'guess':
+        return self.guess_lexer(source)
+    elif lang in lexers:
+        return lexers[lang]
+    elif lang in self.unknown_langs:
+        return lexers['none']
+
+    try:
+        lexer = lexers[lang] = get_lexer_by_name(lang, **(opts or {}))
+    except ClassNotFound:
+        logger.warning('Pygments lexer name %r is not known', lang)
+        self.unknown_langs.add(lang)
+        return lexers['none']
+    lexer.add_filter('raiseonerror')
+    return lexer
+
+   def guess_lexer(self, source):
+    '''
+       Guess a lexer from the head of a literal block only, since every
+       lexer analyses the whole text. Lexers are memoized by the head
+       until reset_guesses is called at the next source document.
+    '''
+    start = time.time()
+    sample = source[:guess_sample_size]
+    lexer = self.guess_memo.get(sample)
+    if lexer is None:
+        try:
+            lexer = guess_lexer(sample)
+        except Exception:
+            lexer = highlighting.lexers['none']
+        if len(self.guess_memo) >= guess_memo_size:
+            self.guess_memo.clear()
+        self.guess_memo[sample] = lexer
+    self.guessed_blocks += 1
+    self.guess_time += time.time() - start
+    return lexer
+
+   def reset_guesses(self):
+    self.guess_memo = {}
+
+   def prepare_source(self, source, lexer):
+    if not isinstance(source, unicode):
+        source = source.decode()
+
+    # trim doctest options if wanted
+    if isinstance(lexer, PythonConsoleLexer) and self.trim_doctest_flags:
+        source = doctest.blankline_re.sub('', source)
+        source = doctest.doctestopt_re.sub('', source)
+    return source
+
+   def warn_lex_error(self, lang):
+    # this is most probably not the selected language,
+    # so let it pass unhighlighted
+    if lang != 'default':
+        logger.warning('Could not lex literal_block as "%s". '
+                       'Highlighting skipped.', lang)
+
+   def get_tokens(self, source, lang, opts=None, lexer=None):
+    '''
+       Lex a literal block, and return the list of tokens
+    '''
+    if not isinstance(source, unicode):
+        source = source.decode()
+    if lexer is None:
+        lexer = self.get_lexer(source, lang, opts)
+    source = self.prepare_source(source, lexer)
+
+    try:
+        return list(lexer.get_tokens(source))
+    except ErrorToken:
+        self.warn_lex_error(lang)
+        return list(highlighting.lexers['none'].get_tokens(source))
+
+   def iter_tokens(self, source, lang, opts=None, max_lines=0):
+    '''
+       Generate tokens of a literal block as the lexer makes them.
+       The text after 'max_lines' lines, or after a lexer error,
+       is generated as a plain text token.
+    '''
+    if not isinstance(source, unicode):
+        source = source.decode()
+    lexer = self.get_lexer(source, lang, opts)
+    source = self.prepare_source(source, lexer)
+    # the values of the tokens add up to the text, not to the source
+    text = preprocess_source(source, lexer)
+
+    self.streamed_blocks += 1
+    consumed = 0
+    lines = 0
+    try:
+        for ttype, value in lexer.get_tokens(source):
+            if max_lines and lines >= max_lines:
+                self.plain_lines += len(text[consumed:].splitlines())
+                break
+            yield ttype, value
+            consumed += len(value)
+            lines += value.count('\n')
+        else:
+            return
+    except ErrorToken:
+        self.warn_lex_error(lang)
+
+    rest = text[consumed:]
+    if rest:
+        yield Token.Text, rest
+
+   def iter_runs(self, tokens, **kwargs):
+    '''
+       Generate 'w:r' elements from tokens
+    '''
+    kwargs.update(self.formatter_args)
+    kwargs['token_styles'] = self.token_styles
+    kwargs['style_ids'] = self.style_ids
+    return self.run_formatter(**kwargs).iter_runs(tokens)
+
+   def format_runs(self, tokens, **kwargs):
+    '''
+       Make 'w:r' elements from tokens
+    '''
+    return list(self.iter_runs(tokens, **kwargs))
+
+   def highlight_runs(self, source, lang, opts=None, **kwargs):
+    '''
+       Highlight a literal block, and return 'w:r' elements
+    '''
+    return self.format_runs(self.get_tokens(source, lang, opts), **kwargs)
+
+   def get_token_styles(self):
+    '''
+       Get character styles for all styled token types,
+       as a list of (style name, style id, 'w:rPr' element)
+    '''
+    formatter = self.run_formatter(**self.formatter_args)
+    result = []
+    for ttype, _ in formatter.style:
+        rPr, ref = formatter.get_property_entry(ttype)
+        if rPr is None:
+            continue
+        styname = token_style_id(ttype)
+        self.token_style_savings[styname] = len(etree.tostring(rPr)) - len(etree.tostring(ref))
+        result.append((token_style_name(ttype), styname, copy.deepcopy(rPr)))
+    result.sort(key=lambda x: x[1])
+    return result
+
+   def add_token_styles(self, docx):
+    '''
+       Add the token styles to the composer. A style of the template which
+       has the same name takes precedence, and runs refer it by its id.
+    '''
+    for styname, styleid, rPr in self.get_token_styles():
+        template_id = docx.stylenames.get(styname)
+        if template_id is None:
+            docx.new_character_style(styname, rPr, styleid)
+        elif template_id != styleid:
+            self.style_ids[styleid] = template_id
+            self.token_style_savings[template_id] = self.token_style_savings[styleid]
 
+   def get_saved_bytes(self, run):
+    '''
+       Estimate bytes which a run saved by referring a token style
+    '''
+    rstyle = run.find(rstyle_path)
+    if rstyle is None:
+        return 0
+    return self.token_style_savings.get(rstyle.get(w_tag('val')), 0)
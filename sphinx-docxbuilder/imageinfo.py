@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinx-docxbuilder imageinfo
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Read the pixel size and the resolution of images from their headers,
+    and keep them between builds.
+
+    :license: MIT, see LICENSE for details.
+"""
+
+import os
+import struct
+import cPickle as pickle
+
+#
+# Is the PIL imaging library installed?
+try:
+    import Image
+except ImportError, exp:
+    Image = None
+
+default_dpi = (72, 72)
+
+# bump this when the probed values change
+info_format_version = 1
+
+
+###### Header readers, they return ((width, height), (xdpi, ydpi)) or None
+def read_png_info(f):
+    head = f.read(24)
+    if len(head) < 24 or head[12:16] != 'IHDR':
+        return None
+    size = struct.unpack('>II', head[16:24])
+    dpi = default_dpi
+
+    # pHYs must be placed before the first IDAT chunk
+    f.seek(8 + 8 + 13 + 4)
+    while True:
+        chunk = f.read(8)
+        if len(chunk) < 8:
+            break
+        length, ctype = struct.unpack('>I4s', chunk)
+        if ctype == 'pHYs':
+            data = f.read(9)
+            if len(data) == 9:
+                px, py, unit = struct.unpack('>IIB', data)
+                if unit == 1:
+                    dpi = (int(px * 0.0254 + 0.5), int(py * 0.0254 + 0.5))
+            break
+        if ctype in ('IDAT', 'IEND'):
+            break
+        f.seek(length + 4, 1)
+    return size, dpi
+
+def read_gif_info(f):
+    head = f.read(10)
+    if len(head) < 10:
+        return None
+    return struct.unpack('<HH', head[6:10]), default_dpi
+
+def read_bmp_info(f):
+    head = f.read(26)
+    if len(head) < 26:
+        return None
+    header_size = struct.unpack('<I', head[14:18])[0]
+    if header_size == 12:
+        return struct.unpack('<HH', head[18:22]), default_dpi
+    if header_size < 40:
+        return None
+    width, height = struct.unpack('<ii', head[18:26])
+    dpi = default_dpi
+    f.seek(38)
+    data = f.read(8)
+    if len(data) == 8:
+        ppm = struct.unpack('<ii', data)
+        if ppm[0] > 0 and ppm[1] > 0:
+            dpi = (int(ppm[0] / 39.3701 + 0.5), int(ppm[1] / 39.3701 + 0.5))
+    return (width, abs(height)), dpi
+
+def read_jpeg_info(f):
+    f.seek(2)
+    dpi = default_dpi
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != '\xff':
+            return None
+        code = ord(marker[1])
+        if code == 0xff:
+            # fill byte
+            f.seek(-1, 1)
+            continue
+        if code in (0x01, 0xd8) or 0xd0 <= code <= 0xd7:
+            continue
+        data = f.read(2)
+        if len(data) < 2:
+            return None
+        length = struct.unpack('>H', data)[0]
+        if code == 0xe0:
+            data = f.read(length - 2)
+            if data[0:5] == 'JFIF\0' and len(data) >= 12:
+                unit = ord(data[7])
+                xdpi, ydpi = struct.unpack('>HH', data[8:12])
+                if unit == 1:
+                    dpi = (xdpi, ydpi)
+                elif unit == 2:
+                    dpi = (int(xdpi * 2.54 + 0.5), int(ydpi * 2.54 + 0.5))
+            continue
+        if 0xc0 <= code <= 0xcf and code not in (0xc4, 0xc8, 0xcc):
+            data = f.read(5)
+            if len(data) < 5:
+                return None
+            height, width = struct.unpack('>HH', data[1:5])
+            return (width, height), dpi
+        f.seek(length - 2, 1)
+
+header_readers = [
+    ('\x89PNG\r\n\x1a\n', read_png_info),
+    ('GIF87a', read_gif_info),
+    ('GIF89a', read_gif_info),
+    ('BM', read_bmp_info),
+    ('\xff\xd8', read_jpeg_info),
+]
+
+def read_header_info(filename):
+    '''
+       Get the pixel size and the dpi from the header of an image file,
+       or None if the format is unknown
+    '''
+    f = open(filename, 'rb')
+    try:
+        magic = f.read(8)
+        for prefix, reader in header_readers:
+            if magic.startswith(prefix):
+                f.seek(0)
+                try:
+                    return reader(f)
+                except struct.error:
+                    return None
+    finally:
+        f.close()
+    return None
+
+def probe_image(filename):
+    '''
+       Get the pixel size and the dpi of an image file
+    '''
+    try:
+        info = read_header_info(filename)
+    except IOError:
+        info = None
+    if info is not None and info[0][0] and info[0][1]:
+        return info
+
+    dpi = default_dpi
+
+    if Image is None :
+        raise RuntimeError('image size not fully specified and PIL not installed')
+
+    try:
+        imageobj = Image.open(filename, 'r')
+    except:
+        raise RuntimeError('Fail to open image file: %s' % filename)
+
+    dpi = imageobj.info.get('dpi', dpi)
+    # dpi information can be (xdpi, ydpi) or xydpi
+    try: iter(dpi)
+    except: dpi = (dpi, dpi)
+
+    return tuple(imageobj.size[0:2]), tuple(dpi)
+
+#
+#  ImageInfoCache class
+#   (size, dpi) of image files by their path, which are valid while
+#   the modification time and the size of the file are not changed.
+#
+class ImageInfoCache:
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.entries = {}
+        self.modified = False
+        self.hits = 0
+        self.misses = 0
+        if filename:
+            self.load()
+
+    def load(self):
+        try:
+            f = open(self.filename, 'rb')
+            try:
+                version, entries = pickle.load(f)
+            finally:
+                f.close()
+        except Exception:
+            return
+        if version == info_format_version:
+            self.entries = entries
+
+    def save(self):
+        '''
+           Write the cache file atomically, if it is modified
+        '''
+        if not self.filename or not self.modified:
+            return
+        try:
+            dirname = os.path.dirname(self.filename)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            tmpname = '%s.%d' % (self.filename, os.getpid())
+            f = open(tmpname, 'wb')
+            try:
+                pickle.dump((info_format_version, self.entries), f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(tmpname, self.filename)
+        except (IOError, OSError):
+            return
+        self.modified = False
+
+    def get_stamp(self, filename):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def get(self, filename):
+        '''
+           Get (size, dpi) of an image, or None
+        '''
+        path = os.path.abspath(filename)
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == self.get_stamp(path):
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def put(self, filename, info):
+        path = os.path.abspath(filename)
+        stamp = self.get_stamp(path)
+        if stamp is None:
+            return
+        self.entries[path] = (stamp, info)
+        self.modified = True
+
+    def probe(self, filename):
+        '''
+           Get (size, dpi) of an image from the cache, or probe the image
+        '''
+        info = self.get(filename)
+        if info is None:
+            info = probe_image(filename)
+            self.put(filename, info)
+        return info
+
+    def summary(self):
+        return '%d hits, %d probed' % (self.hits, self.misses)
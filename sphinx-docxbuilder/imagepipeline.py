@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinx-docxbuilder imagepipeline
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Resample embedded images to their display resolution, recompress
+    them and convert formats which Word does not handle well, before
+    they are stored in the package.
+
+    :license: MIT, see LICENSE for details.
+"""
+
+import os
+import time
+import multiprocessing
+from cStringIO import StringIO
+
+from cache import make_key
+
+#
+# Is the PIL imaging library installed?
+try:
+    import Image
+except ImportError, exp:
+    Image = None
+
+# bump this when the images made by transform_image change
+pipeline_version = '1'
+image_version = getattr(Image, '__version__', getattr(Image, 'VERSION', ''))
+
+# extension -> PIL format
+image_formats = {'.png': 'PNG', '.jpeg': 'JPEG', '.jpg': 'JPEG', '.gif': 'GIF'}
+
+
+###### Job function (it must be picklable for the process pool)
+def transform_image(filename, target_size, ext, quality):
+    '''
+       Resample an image to 'target_size' (or keep its size if None), and
+       encode it in the format of 'ext'. Return the encoded data, or an
+       empty string if the original file is smaller and can be kept.
+    '''
+    imageobj = Image.open(filename)
+    imageobj.load()
+    fmt = image_formats[ext]
+    converted = image_formats.get(os.path.splitext(filename)[1].lower()) != fmt
+
+    if target_size is not None :
+        if imageobj.mode == 'P' and fmt != 'GIF' :
+            imageobj = imageobj.convert('RGBA')
+        if imageobj.mode in ('P', '1') :
+            imageobj = imageobj.resize(target_size, Image.NEAREST)
+        else:
+            imageobj = imageobj.resize(target_size, Image.ANTIALIAS)
+
+    options = {}
+    if fmt == 'JPEG' :
+        if imageobj.mode not in ('RGB', 'L', 'CMYK') :
+            imageobj = imageobj.convert('RGB')
+        options['quality'] = quality
+        options['optimize'] = True
+    elif fmt == 'PNG' :
+        options['optimize'] = True
+
+    buf = StringIO()
+    imageobj.save(buf, fmt, **options)
+    data = buf.getvalue()
+    if not converted and len(data) >= os.path.getsize(filename) :
+        return ''
+    return data
+
+#
+#  ImagePipeline class
+#
+class ImagePipeline:
+    def __init__(self, cache, image_info, dpi=150, quality=85, convert=None, workers=None):
+        self.cache = cache
+        self.image_info = image_info
+        self.dpi = dpi
+        self.quality = quality
+        self.convert = convert or {}
+        if workers is None :
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+
+        self.resampled = 0
+        self.converted = 0
+        self.cached = 0
+        self.failed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.elapsed = 0.0
+
+    def get_target_size(self, size, display_size):
+        '''
+           Pixel size for the display size (in 1/72 inch), or None
+           if the image is not larger than that
+        '''
+        scale = min(float(display_size[0]) * self.dpi / 72 / size[0],
+                    float(display_size[1]) * self.dpi / 72 / size[1])
+        if scale >= 1.0 :
+            return None
+        return (max(1, int(size[0] * scale + 0.5)), max(1, int(size[1] * scale + 0.5)))
+
+    def collect(self, docx):
+        '''
+           Collect (media, key, job arguments) of images to be transformed
+        '''
+        jobs = []
+        for media in docx.media_files:
+            ext = os.path.splitext(media[0])[1].lower()
+            newext = self.convert.get(ext, ext)
+            if Image is None or newext not in image_formats :
+                continue
+            try:
+                size = self.image_info.probe(media[1])[0]
+            except Exception:
+                continue
+            target_size = self.get_target_size(size, media[3:5])
+            if target_size is None and newext == ext and image_formats[ext] != 'JPEG' :
+                continue
+
+            key = make_key('image', pipeline_version, image_version,
+                           docx.get_media_digest(media[1]), target_size, newext, self.quality)
+            jobs.append((media, key, (media[1], target_size, newext, self.quality)))
+        return jobs
+
+    def process(self, docx):
+        '''
+           Transform the media files of the composer
+        '''
+        start = time.time()
+        jobs = self.collect(docx)
+
+        pool = None
+        pending = []
+        for media, key, args in jobs:
+            # the media refer the cache files until the package is written
+            self.cache.pin(key)
+            if self.cache.touch(key) :
+                self.cached += 1
+                pending.append((media, key, args, None))
+            elif self.workers :
+                if pool is None :
+                    pool = multiprocessing.Pool(self.workers)
+                pending.append((media, key, args, pool.apply_async(transform_image, args)))
+            else:
+                pending.append((media, key, args, transform_image))
+
+        for media, key, args, result in pending:
+            if result is not None :
+                try:
+                    if result is transform_image :
+                        data = transform_image(*args)
+                    else:
+                        data = result.get()
+                except Exception:
+                    self.failed += 1
+                    continue
+                if not self.cache.put(key, data) :
+                    self.failed += 1
+                    continue
+
+            path = self.cache.get_path(key)
+            if not os.path.isfile(path) :
+                self.failed += 1
+                continue
+            if not os.path.getsize(path) :
+                # the original file is kept
+                continue
+            self.bytes_in += os.path.getsize(media[1])
+            self.bytes_out += os.path.getsize(path)
+            if args[1] is not None :
+                self.resampled += 1
+            ext = os.path.splitext(media[0])[1].lower()
+            if args[2] != ext :
+                self.converted += 1
+                docx.set_media_file(media, path, args[2])
+            else:
+                docx.set_media_file(media, path)
+
+        if pool is not None :
+            pool.close()
+            pool.join()
+        self.elapsed += time.time() - start
+
+    def release(self):
+        '''
+           Release the cache files after the package is written
+        '''
+        self.cache.release()
+
+    def summary(self):
+        return '%d resampled, %d converted (%d cached, %d failed), %d bytes to %d bytes in %.2fs' % (
+                self.resampled, self.converted, self.cached, self.failed,
+                self.bytes_in, self.bytes_out, self.elapsed)
@@ -0,0 +1,445 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinx-docxbuilder omml
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Convert a subset of LaTeX math to Office Math (OMML) elements,
+    and keep converted expressions in memory and on disk.
+
+    :license: MIT, see LICENSE for details.
+"""
+
+import re
+import time
+
+from lxml import etree
+
+from cache import make_key
+
+math_ns = 'http://schemas.openxmlformats.org/officeDocument/2006/math'
+math_nsmap = {'m': math_ns}
+xml_space = '{http://www.w3.org/XML/1998/namespace}space'
+
+# bump this when the elements made by MathParser change
+omml_version = '1'
+
+def m_tag(name):
+    return '{%s}%s' % (math_ns, name)
+
+symbols = {
+    # greek letters
+    'alpha': u'\u03b1', 'beta': u'\u03b2', 'gamma': u'\u03b3', 'delta': u'\u03b4',
+    'epsilon': u'\u03f5', 'varepsilon': u'\u03b5', 'zeta': u'\u03b6', 'eta': u'\u03b7',
+    'theta': u'\u03b8', 'vartheta': u'\u03d1', 'iota': u'\u03b9', 'kappa': u'\u03ba',
+    'lambda': u'\u03bb', 'mu': u'\u03bc', 'nu': u'\u03bd', 'xi': u'\u03be',
+    'pi': u'\u03c0', 'varpi': u'\u03d6', 'rho': u'\u03c1', 'varrho': u'\u03f1',
+    'sigma': u'\u03c3', 'varsigma': u'\u03c2', 'tau': u'\u03c4', 'upsilon': u'\u03c5',
+    'phi': u'\u03d5', 'varphi': u'\u03c6', 'chi': u'\u03c7', 'psi': u'\u03c8',
+    'omega': u'\u03c9',
+    'Gamma': u'\u0393', 'Delta': u'\u0394', 'Theta': u'\u0398', 'Lambda': u'\u039b',
+    'Xi': u'\u039e', 'Pi': u'\u03a0', 'Sigma': u'\u03a3', 'Upsilon': u'\u03a5',
+    'Phi': u'\u03a6', 'Psi': u'\u03a8', 'Omega': u'\u03a9',
+    # operators and relations
+    'times': u'\u00d7', 'cdot': u'\u22c5', 'div': u'\u00f7', 'pm': u'\u00b1',
+    'mp': u'\u2213', 'ast': u'\u2217', 'circ': u'\u2218', 'bullet': u'\u2219',
+    'leq': u'\u2264', 'le': u'\u2264', 'geq': u'\u2265', 'ge': u'\u2265',
+    'neq': u'\u2260', 'ne': u'\u2260', 'approx': u'\u2248', 'equiv': u'\u2261',
+    'sim': u'\u223c', 'simeq': u'\u2243', 'cong': u'\u2245', 'propto': u'\u221d',
+    'll': u'\u226a', 'gg': u'\u226b', 'in': u'\u2208', 'notin': u'\u2209',
+    'subset': u'\u2282', 'supset': u'\u2283', 'subseteq': u'\u2286', 'supseteq': u'\u2287',
+    'cup': u'\u222a', 'cap': u'\u2229', 'setminus': u'\u2216', 'emptyset': u'\u2205',
+    'forall': u'\u2200', 'exists': u'\u2203', 'neg': u'\u00ac', 'lnot': u'\u00ac',
+    'wedge': u'\u2227', 'land': u'\u2227', 'vee': u'\u2228', 'lor': u'\u2228',
+    'to': u'\u2192', 'rightarrow': u'\u2192', 'leftarrow': u'\u2190', 'gets': u'\u2190',
+    'Rightarrow': u'\u21d2', 'Leftarrow': u'\u21d0', 'leftrightarrow': u'\u2194',
+    'Leftrightarrow': u'\u21d4', 'mapsto': u'\u21a6', 'implies': u'\u27f9', 'iff': u'\u27fa',
+    'infty': u'\u221e', 'partial': u'\u2202', 'nabla': u'\u2207', 'hbar': u'\u210f',
+    'ell': u'\u2113', 'Re': u'\u211c', 'Im': u'\u2111', 'aleph': u'\u2135',
+    'prime': u'\u2032', 'angle': u'\u2220', 'perp': u'\u22a5', 'parallel': u'\u2225',
+    'ldots': u'\u2026', 'cdots': u'\u22ef', 'vdots': u'\u22ee', 'ddots': u'\u22f1',
+    'dots': u'\u2026', 'langle': u'\u27e8', 'rangle': u'\u27e9',
+    'lceil': u'\u2308', 'rceil': u'\u2309', 'lfloor': u'\u230a', 'rfloor': u'\u230b',
+    'lbrace': u'{', 'rbrace': u'}', 'vert': u'|', 'Vert': u'\u2016', 'mid': u'|',
+    # spaces
+    ',': u'\u2009', ':': u'\u205f', ';': u'\u2005', '!': u'', ' ': u' ',
+    'quad': u'\u2003', 'qquad': u'\u2003\u2003',
+    # escaped characters
+    '{': u'{', '}': u'}', '%': u'%', '$': u'$', '&': u'&', '#': u'#', '_': u'_',
+    '|': u'\u2016',
+}
+
+nary_operators = {
+    'sum': u'\u2211', 'prod': u'\u220f', 'coprod': u'\u2210',
+    'int': u'\u222b', 'iint': u'\u222c', 'iiint': u'\u222d', 'oint': u'\u222e',
+    'bigcup': u'\u22c3', 'bigcap': u'\u22c2', 'bigvee': u'\u22c1', 'bigwedge': u'\u22c0',
+}
+
+functions = set([
+    'sin', 'cos', 'tan', 'cot', 'sec', 'csc', 'arcsin', 'arccos', 'arctan',
+    'sinh', 'cosh', 'tanh', 'log', 'ln', 'lg', 'exp', 'lim', 'liminf', 'limsup',
+    'max', 'min', 'sup', 'inf', 'det', 'dim', 'ker', 'deg', 'gcd', 'arg', 'Pr',
+])
+
+# commands which take a text argument, and the style of the run
+text_commands = {
+    'mathrm': 'p', 'text': 'p', 'textrm': 'p', 'operatorname': 'p', 'mbox': 'p',
+    'mathbf': 'b', 'textbf': 'b', 'boldsymbol': 'bi', 'mathit': 'i', 'textit': 'i',
+}
+
+# commands which are ignored with their argument kept
+ignored_commands = set(['displaystyle', 'textstyle', 'scriptstyle', 'limits', 'nolimits',
+                        'left.', 'right.', 'big', 'Big', 'bigg', 'Bigg', 'nonumber',
+                        'label', 'mathcal', 'mathbb', 'mathsf', 'mathtt', 'mathfrak'])
+
+accents = {
+    'hat': u'\u0302', 'widehat': u'\u0302', 'bar': u'\u0305', 'overline': u'\u0305',
+    'tilde': u'\u0303', 'widetilde': u'\u0303', 'vec': u'\u20d7', 'dot': u'\u0307',
+    'ddot': u'\u0308',
+}
+
+token_re = re.compile(r'\\([a-zA-Z]+|.)|(\s+)|([0-9]+(?:\.[0-9]+)?)|([a-zA-Z]+)|(.)', re.S)
+
+def tokenize(latex):
+    '''
+       Split LaTeX into (kind, value), kind is 'cmd', 'num', 'text' or 'char'
+    '''
+    tokens = []
+    for m in token_re.finditer(latex):
+        cmd, space, num, text, char = m.groups()
+        if cmd is not None:
+            tokens.append(('cmd', cmd))
+        elif num is not None:
+            tokens.append(('num', num))
+        elif text is not None:
+            tokens.append(('text', text))
+        elif char is not None:
+            tokens.append(('char', char))
+    return tokens
+
+#
+#  MathParser class
+#   A recursive descent parser which makes a list of OMML elements
+#   for the argument of 'm:oMath'.
+#
+class MathParser:
+    def __init__(self, latex):
+        self.tokens = tokenize(latex)
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def element(self, name, *children):
+        elem = etree.Element(m_tag(name), nsmap=math_nsmap)
+        for child in children:
+            elem.append(child)
+        return elem
+
+    def container(self, name, elements):
+        elem = self.element(name)
+        for child in elements:
+            elem.append(child)
+        return elem
+
+    def prop(self, name, value):
+        elem = self.element(name)
+        elem.set(m_tag('val'), value)
+        return elem
+
+    def run(self, text, sty=None):
+        r = self.element('r')
+        if sty is not None:
+            rPr = etree.SubElement(r, m_tag('rPr'))
+            etree.SubElement(rPr, m_tag('sty')).set(m_tag('val'), sty)
+        t = etree.SubElement(r, m_tag('t'))
+        if text != text.strip():
+            t.set(xml_space, 'preserve')
+        t.text = text
+        return r
+
+    def parse(self):
+        return self.parse_sequence(None)
+
+    def parse_sequence(self, stop):
+        '''
+           Parse elements until the 'stop' character (or a '\\right')
+        '''
+        result = []
+        while True:
+            kind, value = self.peek()
+            if kind is None:
+                break
+            if kind == 'char' and value == stop:
+                self.pos += 1
+                break
+            if kind == 'cmd' and value == 'right' and stop == 'right':
+                break
+            atom = self.parse_atom()
+            if atom is None:
+                continue
+            result.append(self.parse_scripts(atom))
+        return result
+
+    def parse_argument(self):
+        '''
+           Parse a '{...}' group or a single atom, as a list of elements
+        '''
+        kind, value = self.peek()
+        if kind == 'char' and value == '{':
+            self.pos += 1
+            return self.parse_sequence('}')
+        if kind == 'text' and len(value) > 1:
+            # only the first letter is the argument
+            self.tokens[self.pos] = ('text', value[1:])
+            return [self.run(value[0])]
+        atom = self.parse_atom()
+        if atom is None:
+            return []
+        return [atom]
+
+    def parse_text_argument(self):
+        '''
+           Get the raw text of a '{...}' group
+        '''
+        kind, value = self.peek()
+        if not (kind == 'char' and value == '{'):
+            self.pos += 1
+            return value or ''
+        self.pos += 1
+        depth = 1
+        text = []
+        while self.pos < len(self.tokens):
+            kind, value = self.next()
+            if kind == 'char' and value == '{':
+                depth += 1
+            elif kind == 'char' and value == '}':
+                depth -= 1
+                if depth == 0:
+                    break
+            if kind == 'cmd':
+                text.append(symbols.get(value, value))
+            else:
+                text.append(value)
+        return ''.join(text)
+
+    def parse_scripts(self, base):
+        '''
+           Attach subscripts and superscripts to the base element
+        '''
+        sub = sup = None
+        while True:
+            kind, value = self.peek()
+            if kind == 'char' and value == '_' and sub is None:
+                self.pos += 1
+                sub = self.parse_argument()
+            elif kind == 'char' and value == '^' and sup is None:
+                self.pos += 1
+                sup = self.parse_argument()
+            elif kind == 'char' and value == "'" and sup is None:
+                self.pos += 1
+                sup = [self.run(u'\u2032')]
+            else:
+                break
+
+        if sub is None and sup is None:
+            return base
+        if base.tag == m_tag('nary'):
+            self.set_nary_limits(base, sub, sup)
+            return base
+        e = self.container('e', [base])
+        if sup is None:
+            return self.element('sSub', e, self.container('sub', sub))
+        if sub is None:
+            return self.element('sSup', e, self.container('sup', sup))
+        return self.element('sSubSup', e, self.container('sub', sub), self.container('sup', sup))
+
+    def set_nary_limits(self, nary, sub, sup):
+        naryPr = nary.find(m_tag('naryPr'))
+        for name, value in (('sub', sub), ('sup', sup)):
+            if value is None:
+                continue
+            hide = naryPr.find(m_tag(name + 'Hide'))
+            if hide is not None:
+                naryPr.remove(hide)
+            elem = nary.find(m_tag(name))
+            for child in value:
+                elem.append(child)
+
+    def parse_delimiter(self):
+        kind, value = self.next()
+        if kind == 'cmd':
+            if value == '.':
+                return ''
+            return symbols.get(value, value)
+        return value or ''
+
+    def parse_atom(self):
+        kind, value = self.next()
+        if kind is None:
+            return None
+        if kind == 'num':
+            return self.run(value)
+        if kind == 'text':
+            return self.run(value)
+        if kind == 'char':
+            if value == '{':
+                return self.container('box', [self.container('e', self.parse_sequence('}'))])
+            if value in '}^_&':
+                return None
+            if value == '~':
+                return self.run(u'\u00a0')
+            if value == '-':
+                return self.run(u'\u2212')
+            return self.run(value)
+        return self.parse_command(value)
+
+    def parse_command(self, name):
+        if name == 'frac' or name == 'dfrac' or name == 'tfrac':
+            num = self.parse_argument()
+            den = self.parse_argument()
+            return self.element('f', self.container('num', num), self.container('den', den))
+        if name == 'sqrt':
+            deg = None
+            kind, value = self.peek()
+            if kind == 'char' and value == '[':
+                self.pos += 1
+                deg = self.parse_sequence(']')
+            arg = self.parse_argument()
+            radPr = self.element('radPr')
+            if deg is None:
+                radPr.append(self.prop('degHide', '1'))
+                deg = []
+            return self.element('rad', radPr, self.container('deg', deg), self.container('e', arg))
+        if name == 'left':
+            beg = self.parse_delimiter()
+            body = self.parse_sequence('right')
+            end = ''
+            if self.peek() == ('cmd', 'right'):
+                self.pos += 1
+                end = self.parse_delimiter()
+            dPr = self.element('dPr', self.prop('begChr', beg), self.prop('endChr', end))
+            return self.element('d', dPr, self.container('e', body))
+        if name in nary_operators:
+            naryPr = self.element('naryPr', self.prop('chr', nary_operators[name]))
+            if not name.endswith('int'):
+                naryPr.append(self.prop('limLoc', 'undOvr'))
+            naryPr.append(self.prop('subHide', '1'))
+            naryPr.append(self.prop('supHide', '1'))
+            nary = self.element('nary', naryPr, self.element('sub'), self.element('sup'))
+            nary = self.parse_scripts(nary)
+            body = []
+            kind, value = self.peek()
+            if kind is not None and not (kind == 'char' and value in '}&') and \
+                    (kind, value) != ('cmd', 'right'):
+                atom = self.parse_atom()
+                if atom is not None:
+                    body.append(self.parse_scripts(atom))
+            nary.append(self.container('e', body))
+            return nary
+        if name in accents:
+            arg = self.parse_argument()
+            accPr = self.element('accPr', self.prop('chr', accents[name]))
+            return self.element('acc', accPr, self.container('e', arg))
+        if name in text_commands:
+            return self.run(self.parse_text_argument(), text_commands[name])
+        if name in functions:
+            return self.run(name, 'p')
+        if name in symbols:
+            if not symbols[name]:
+                return None
+            return self.run(symbols[name])
+        if name in ignored_commands:
+            if name == 'label':
+                self.parse_text_argument()
+            return None
+        if name == 'begin' or name == 'end':
+            # environments like aligned or split are flattened
+            self.parse_text_argument()
+            return None
+        if name == '\\':
+            return None
+        # unknown commands are shown as they are
+        return self.run('\\' + name, 'p')
+
+def split_math_lines(latex):
+    '''
+       Split display math into lines by blank lines and '\\\\'
+    '''
+    lines = []
+    for block in re.split(r'\n\s*\n', latex):
+        for line in re.split(r'\\\\', block):
+            if line.strip():
+                lines.append(line)
+    return lines
+
+def make_omath(latex):
+    omath = etree.Element(m_tag('oMath'), nsmap=math_nsmap)
+    try:
+        elements = MathParser(latex).parse()
+    except RuntimeError:
+        # too deeply nested, the source is shown as it is
+        elements = [MathParser('').run(latex, 'p')]
+    for elem in elements:
+        omath.append(elem)
+    return omath
+
+def latex_to_omml(latex, display=False):
+    '''
+       Convert LaTeX to a serialized 'm:oMath', or 'm:oMathPara' for display math
+    '''
+    if not display:
+        return etree.tostring(make_omath(latex), encoding='UTF-8')
+
+    para = etree.Element(m_tag('oMathPara'), nsmap=math_nsmap)
+    for line in split_math_lines(latex):
+        para.append(make_omath(line))
+    return etree.tostring(para, encoding='UTF-8')
+
+#
+#  MathConverter class
+#   Converted expressions are kept in memory by the expression,
+#   and in a content cache between builds.
+#
+class MathConverter:
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.converted = {}
+        self.hits = 0
+        self.misses = 0
+        self.elapsed = 0.0
+
+    def convert(self, latex, display=False):
+        '''
+           Get a new 'm:oMath' (or 'm:oMathPara') element of LaTeX
+        '''
+        key = (latex, display)
+        data = self.converted.get(key)
+        if data is None and self.cache is not None:
+            cache_key = make_key('omml', omml_version, latex, display)
+            data = self.cache.get(cache_key)
+        if data is None:
+            start = time.time()
+            data = latex_to_omml(latex, display)
+            self.elapsed += time.time() - start
+            self.misses += 1
+            if self.cache is not None:
+                self.cache.put(cache_key, data)
+        else:
+            self.hits += 1
+        self.converted[key] = data
+        return etree.fromstring(data)
+
+    def summary(self):
+        total = self.hits + self.misses
+        rate = 0.0
+        if total:
+            rate = 100.0 * self.hits / total
+        return '%d expressions, %d converted in %.3fs (%.0f%% hit rate)' % (
+                total, self.misses, self.elapsed, rate)
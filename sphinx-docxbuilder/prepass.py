@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinx-docxbuilder prepass
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Run expensive leaf jobs of an assembled doctree (image probing,
+    graphviz rendering and highlighting) concurrently before the
+    translation, and stash the results on the nodes.
+
+    :license: MIT, see LICENSE for details.
+"""
+
+import os
+import time
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from docutils import nodes
+from sphinx import addnodes
+from sphinx.ext import graphviz
+from pygments.token import Token
+
+from imageinfo import probe_image
+from dotrender import DotRenderer
+from highlight import DocxPygmentsBridge, highlight_cache_key, is_streamed_block
+
+
+###### Job functions (they must be picklable for the process pool)
+_highlighters = {}
+
+def lex_block(stylename, trim_doctest_flags, source, lang, picklable):
+    '''
+       Lex a literal block in the same way as the translator.
+       Token types are passed as tuples between processes.
+       The time of guessing the language is returned with the tokens.
+    '''
+    key = (stylename, trim_doctest_flags)
+    highlighter = _highlighters.get(key)
+    if highlighter is None :
+        highlighter = DocxPygmentsBridge('html', stylename, trim_doctest_flags)
+        _highlighters[key] = highlighter
+
+    lexer = None
+    guess_time = None
+    if lang == 'guess' :
+        start = time.time()
+        lexer = highlighter.guess_lexer(source)
+        guess_time = time.time() - start
+    tokens = highlighter.get_tokens(source, lang, lexer=lexer)
+    if picklable :
+        tokens = [ (tuple(ttype), value) for ttype, value in tokens ]
+    return tokens, guess_time
+
+def get_token_type(names):
+    '''
+       Get the token type from a tuple of names
+    '''
+    ttype = Token
+    for name in names:
+        ttype = getattr(ttype, name)
+    return ttype
+
+def render_graphviz(renderer, code, options):
+    '''
+       Render a graphviz diagram to png, and probe the rendered image
+    '''
+    fname, filename = renderer.render(code, options, 'png')
+    return fname, filename, probe_image(filename)
+
+def timed_call(func, args):
+    '''
+       Call a job, and return its result with the elapsed time
+    '''
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+#
+#  TranslationPrepass class
+#
+class TranslationPrepass:
+    def __init__(self, builder, workers=None, executor='thread', highlight_cache=None,
+                 image_info=None, dot_renderer=None, graphviz_workers=None):
+        self.builder = builder
+        self.dot_renderer = dot_renderer
+        self.highlight_cache = highlight_cache
+        self.image_info = image_info
+        # the pre-pass is disabled by default, the translator does the jobs serially
+        self.workers = workers or 0
+        self.executor = executor
+        # graphviz diagrams are rendered concurrently even so, dot runs out of the GIL
+        if graphviz_workers is None :
+            graphviz_workers = multiprocessing.cpu_count()
+        self.graphviz_workers = graphviz_workers
+
+        self.njobs = 0
+        self.failed = 0
+        self.guessed_blocks = 0
+        self.guess_time = 0.0
+        self.serial_time = 0.0
+        self.elapsed = 0.0
+
+    def iter_nodes(self, doctree):
+        '''
+           Generate (node, language) in the document order. The language is
+           the one of literal blocks without 'language', which is tracked
+           in the same way as the translator does.
+        '''
+        default = self.builder.config.highlight_language
+        langs = [default]
+        def walk(node):
+            for child in node.children:
+                if not isinstance(child, nodes.Element) :
+                    continue
+                if isinstance(child, addnodes.highlightlang) :
+                    langs[-1] = child['lang']
+                    continue
+                if isinstance(child, addnodes.start_of_file) :
+                    langs.append(default)
+                    for x in walk(child):
+                        yield x
+                    langs.pop()
+                    continue
+                yield child, langs[-1]
+                for x in walk(child):
+                    yield x
+        return walk(doctree)
+
+    def collect(self, doctree):
+        '''
+           Collect jobs of expensive leaf nodes in the document order
+        '''
+        config = self.builder.config
+        srcdir = self.builder.env.srcdir
+        renderer = self.dot_renderer
+        if renderer is None :
+            renderer = DotRenderer(self.builder)
+        jobs = []
+
+        for node, highlightlang in self.iter_nodes(doctree):
+            if isinstance(node, graphviz.graphviz):
+                if self.graphviz_workers :
+                    jobs.append((node, 'graphviz', render_graphviz,
+                                 (renderer, node['code'], node['options'])))
+            elif not self.workers :
+                continue
+            elif isinstance(node, nodes.image):
+                file_path = os.path.join(srcdir, node['uri'])
+                if self.image_info is not None :
+                    info = self.image_info.get(file_path)
+                    if info is not None :
+                        node['docx_image_info'] = info
+                        continue
+                jobs.append((node, 'image', probe_image, (file_path,)))
+            elif isinstance(node, nodes.literal_block):
+                if is_streamed_block(node.astext(), config.docx_highlight_stream_size,
+                                     config.docx_highlight_max_lines) :
+                    continue
+                lang = node.get('language', highlightlang)
+                if self.highlight_cache is not None :
+                    key = highlight_cache_key(node.astext(), lang,
+                            config.pygments_style, config.trim_doctest_flags,
+                            node.get('highlight_args', {}),
+                            token_styles=config.docx_highlight_token_styles)
+                    if self.highlight_cache.has(key) :
+                        continue
+                args = (config.pygments_style, config.trim_doctest_flags,
+                        node.astext(), lang, self.executor == 'process')
+                jobs.append((node, 'highlight', lex_block, args))
+        return jobs
+
+    def get_pool(self, pools, kind):
+        '''
+           graphviz jobs refer the builder, so they run in their own threads
+        '''
+        if kind == 'graphviz' :
+            name = 'graphviz'
+        elif self.executor == 'process' :
+            name = 'process'
+        else:
+            name = 'thread'
+        if name not in pools :
+            if name == 'process' :
+                pools[name] = multiprocessing.Pool(self.workers)
+            elif name == 'graphviz' :
+                pools[name] = ThreadPool(self.graphviz_workers)
+            else:
+                pools[name] = ThreadPool(self.workers)
+        return pools[name]
+
+    def store(self, node, kind, job_args, result):
+        '''
+           Stash a result on the node for the translator
+        '''
+        if kind == 'image' :
+            node['docx_image_info'] = result
+            if self.image_info is not None :
+                self.image_info.put(job_args[0], result)
+        elif kind == 'graphviz' :
+            node['docx_graphviz'] = result[0:2]
+            node['docx_image_info'] = result[2]
+        elif kind == 'highlight' :
+            tokens, guess_time = result
+            if guess_time is not None :
+                self.guessed_blocks += 1
+                self.guess_time += guess_time
+            if job_args[-1] :
+                tokens = [ (get_token_type(ttype), value) for ttype, value in tokens ]
+            node['docx_highlighted'] = (job_args[2], tokens)
+
+    def run(self, doctree):
+        '''
+           Run all jobs of the doctree concurrently
+        '''
+        if not self.workers and not self.graphviz_workers :
+            return
+
+        start = time.time()
+        jobs = self.collect(doctree)
+        pools = {}
+        pending = []
+        for node, kind, func, args in jobs:
+            result = self.get_pool(pools, kind).apply_async(timed_call, (func, args))
+            pending.append((node, kind, args, result))
+
+        for node, kind, args, result in pending:
+            try:
+                value, elapsed = result.get()
+            except Exception, exc:
+                self.failed += 1
+                if kind == 'graphviz' :
+                    # a placeholder is inserted instead of the diagram,
+                    # and the translator reports the error without running dot again
+                    node['docx_graphviz_error'] = unicode(exc)
+                # the translator does other jobs again, and reports the error
+                continue
+            self.serial_time += elapsed
+            self.store(node, kind, args, value)
+
+        for pool in pools.values():
+            pool.close()
+            pool.join()
+
+        self.njobs += len(jobs)
+        self.elapsed += time.time() - start
+
+    def summary(self):
+        '''
+           Report how much time the pre-pass saved
+        '''
+        saved = max(self.serial_time - self.elapsed, 0.0)
+        return '%d jobs (%d failed) in %.2fs with %d %s workers and %d graphviz threads, %.2fs serial, %.2fs saved' % (
+                self.njobs, self.failed, self.elapsed, self.workers, self.executor,
+                self.graphviz_workers, self.serial_time, saved)
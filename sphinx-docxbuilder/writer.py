@@ -30,22 +30,24 @@ from sphinx import highlighting
 from sphinx.locale import admonitionlabels, versionlabels, _
 
 from sphinx.ext import graphviz
+from sphinx.util import logging as sphinx_logging
 
 import docx
 import sys
 import os
+import urllib
+import urlparse
 import zipfile
 import tempfile
 from lxml import etree
 from highlight import *
-
-
-#
-# Is the PIL imaging library installed?
-try:
-    import Image
-except ImportError, exp:
-    Image = None
+from prepass import TranslationPrepass
+from imageinfo import ImageInfoCache
+from imagepipeline import ImagePipeline
+from dotrender import DotRenderer
+from omml import MathConverter
+from attribution import SourceAttribution
+from cache import ContentCache
 
 #
 #  Logging for debugging
@@ -55,6 +57,9 @@ logging.basicConfig(filename='docx.log', filemode='w', level=logging.INFO,
         format="%(asctime)-15s  %(message)s")
 logger = logging.getLogger('docx')
 
+# warnings of the build
+sphinx_logger = sphinx_logging.getLogger(__name__)
+
 
 def dprint(_func=None, **kw):
     f = sys._getframe(1)
@@ -125,6 +130,9 @@ class DocxWriter(writers.Writer):
         writers.Writer.__init__(self)
         self.builder = builder
         self.docx = docx.DocxComposer()
+        self.docx.xml_backend = self.builder.config['docx_xml_backend']
+        self.docx.compression = self.builder.config['docx_compression']
+        self.docx.compression_threads = self.builder.config['docx_compression_threads']
 
         self.title = self.builder.config['docx_title']
         self.subject = self.builder.config['docx_subject']
@@ -139,10 +147,61 @@ class DocxWriter(writers.Writer):
           self.coverpage = True
 
         stylefile = self.builder.config['docx_style']
-        if stylefile :
-            self.docx.new_document(stylefile)
-        else:
-            self.docx.new_document('style.docx')
+        if not stylefile :
+            stylefile = 'style.docx'
+        self.docx.new_document(stylefile,
+                               os.path.join(self.get_cache_dir(), 'templates'))
+
+        self.highlight_cache = None
+        cache_size = self.builder.config['docx_highlight_cache_size']
+        if cache_size :
+            self.highlight_cache = ContentCache(
+                    os.path.join(self.get_cache_dir(), 'highlight'), cache_size)
+
+        self.image_info = ImageInfoCache(
+                os.path.join(self.get_cache_dir(), 'image-info.pickle'))
+
+        self.image_pipeline = None
+        if self.builder.config['docx_image_resample_dpi'] :
+            self.image_pipeline = ImagePipeline(
+                    ContentCache(os.path.join(self.get_cache_dir(), 'images'),
+                                 self.builder.config['docx_image_cache_size']),
+                    self.image_info,
+                    dpi=self.builder.config['docx_image_resample_dpi'],
+                    quality=self.builder.config['docx_image_quality'],
+                    convert=self.builder.config['docx_image_convert'],
+                    workers=self.builder.config['docx_prepass_workers'])
+
+        self.dot_renderer = DotRenderer(builder,
+                ContentCache(os.path.join(self.get_cache_dir(), 'graphviz'),
+                             self.builder.config['docx_graphviz_cache_size']),
+                timeout=self.builder.config['docx_graphviz_timeout'])
+
+        math_cache = None
+        if self.builder.config['docx_math_cache_size'] :
+            math_cache = ContentCache(os.path.join(self.get_cache_dir(), 'math'),
+                                      self.builder.config['docx_math_cache_size'])
+        self.math_converter = MathConverter(math_cache)
+
+        self.prepass = TranslationPrepass(builder,
+                workers=self.builder.config['docx_prepass_workers'],
+                executor=self.builder.config['docx_prepass_executor'],
+                graphviz_workers=self.builder.config['docx_graphviz_workers'],
+                highlight_cache=self.highlight_cache,
+                image_info=self.image_info,
+                dot_renderer=self.dot_renderer)
+        # (name, summary) pairs reported by the builder
+        self.stats = [('style template', '%s in %.3fs' % (self.docx.styleDocx.template_source,
+                                                          self.docx.styleDocx.template_time))]
+
+    def get_cache_dir(self):
+        '''
+           Directory of persistent caches, which is kept between builds
+        '''
+        cache_dir = self.builder.config['docx_cache_dir']
+        if not cache_dir :
+            cache_dir = os.path.join(self.builder.doctreedir, 'docx-cache')
+        return cache_dir
 
     def save(self, filename):
         self.docx.set_coverpage(self.coverpage)
@@ -155,11 +214,60 @@ class DocxWriter(writers.Writer):
                 descriptions=self.descriptions,
                 keywords=self.keywords)
 
-        self.docx.save(filename)
+        if self.image_pipeline is not None :
+            self.image_pipeline.process(self.docx)
+            self.image_info.save()
+            self.stats.append(('image pipeline', self.image_pipeline.summary()))
+
+        try:
+            self.docx.save(filename)
+        finally:
+            if self.image_pipeline is not None :
+                self.image_pipeline.release()
+        self.stats.append(('compression', self.docx.get_compression_summary()))
+        if self.docx.media_reused :
+            self.stats.append(('media', '%d repeated images shared, %d bytes saved' %
+                               (self.docx.media_reused, self.docx.media_saved_bytes)))
 
     def translate(self):
-        visitor = DocxTranslator(self.document, self.builder, self.docx)
+        self.prepass.run(self.document)
+        if self.prepass.njobs :
+            self.stats.append(('pre-pass', self.prepass.summary()))
+
+        visitor = DocxTranslator(self.document, self.builder, self.docx,
+                                 highlight_cache=self.highlight_cache,
+                                 image_info=self.image_info,
+                                 dot_renderer=self.dot_renderer,
+                                 math_converter=self.math_converter)
         self.document.walkabout(visitor)
+
+        if self.dot_renderer.rendered or self.dot_renderer.reused or self.dot_renderer.timeouts :
+            self.stats.append(('graphviz', self.dot_renderer.summary()))
+        if self.math_converter.hits or self.math_converter.misses :
+            self.stats.append(('math', self.math_converter.summary()))
+        self.image_info.save()
+        if self.image_info.hits or self.image_info.misses :
+            self.stats.append(('image info cache', self.image_info.summary()))
+
+        if self.highlight_cache is not None :
+            self.stats.append(('highlight cache', self.highlight_cache.summary()))
+        guessed_blocks = visitor.highlighter.guessed_blocks + self.prepass.guessed_blocks
+        if guessed_blocks :
+            self.stats.append(('guessed languages', '%d blocks in %.2fs' % (guessed_blocks,
+                               visitor.highlighter.guess_time + self.prepass.guess_time)))
+        if visitor.highlighter.streamed_blocks :
+            self.stats.append(('streamed literal blocks', '%d blocks, %d lines left as plain text' %
+                               (visitor.highlighter.streamed_blocks, visitor.highlighter.plain_lines)))
+        if visitor.highlighter.token_styles :
+            self.stats.append(('token styles', '%d bytes of run properties saved in document.xml'
+                               % visitor.token_style_saved))
+
+        if visitor.attribution is not None :
+            visitor.attribution.finish()
+            filename = os.path.join(self.builder.outdir,
+                    self.builder.config['docx_source_report'])
+            visitor.attribution.write(filename)
+            self.stats.append(('source report', visitor.attribution.summary(filename)))
         self.output = ''  # visitor.body
 
 #
@@ -167,15 +275,28 @@ class DocxWriter(writers.Writer):
 #
 class DocxTranslator(nodes.NodeVisitor):
 
-    def __init__(self, document, builder, docx):
+    def __init__(self, document, builder, docx, highlight_cache=None, image_info=None,
+                 dot_renderer=None, math_converter=None):
         self.builder = builder
         self.docx = docx
+        self.highlight_cache = highlight_cache
+        if dot_renderer is None :
+            dot_renderer = DotRenderer(builder)
+        self.dot_renderer = dot_renderer
+        if math_converter is None :
+            math_converter = MathConverter()
+        self.math_converter = math_converter
+        if image_info is None :
+            image_info = ImageInfoCache()
+        self.image_info = image_info
         nodes.NodeVisitor.__init__(self, document)
 
         self.states = [[]]
         self.list_style = []
         self.sectionlevel = 0
         self.table = None
+        self.table_cursor = None
+        self.table_row = None
 
         self.line_block_level = 0
 
@@ -195,11 +316,24 @@ class DocxTranslator(nodes.NodeVisitor):
         self.current_field_list = None
         self.current_option_list = None
 	self.literal_block_lang = None
+        # language of literal blocks without 'language', set by highlightlang
+        self.highlightlang = builder.config.highlight_language
+        self.highlightlang_stack = []
 
-        self.highlighter = DocxPygmentsBridge('html', builder.config.pygments_style, builder.config.trim_doctest_flags)
+        self.highlighter = DocxPygmentsBridge('html', builder.config.pygments_style,
+                builder.config.trim_doctest_flags,
+                token_styles=builder.config['docx_highlight_token_styles'])
+        self.token_style_saved = 0
+        if self.highlighter.token_styles :
+            self.highlighter.add_token_styles(self.docx)
 
         self.option = []
 
+        self.attribution = None
+        if builder.config['docx_source_report'] :
+            self.attribution = SourceAttribution(docx,
+                    document.get('docname', builder.config.master_doc))
+
     def add_text(self, text):
         '''
 	   Add text in states
@@ -354,6 +488,11 @@ class DocxTranslator(nodes.NodeVisitor):
 	   start of a file
         '''
         dprint()
+        if self.attribution is not None :
+            self.attribution.enter(node['docname'])
+        self.highlightlang_stack.append(self.highlightlang)
+        self.highlightlang = self.builder.config.highlight_language
+        self.highlighter.reset_guesses()
         self.new_state()
         self.sectionlevel = 0
 
@@ -365,6 +504,9 @@ class DocxTranslator(nodes.NodeVisitor):
         '''
         dprint()
         self.end_state()
+        self.highlightlang = self.highlightlang_stack.pop()
+        if self.attribution is not None :
+            self.attribution.leave()
 
     def visit_document(self, node):
         '''
@@ -386,6 +528,7 @@ class DocxTranslator(nodes.NodeVisitor):
 	   start of a hight light
         '''
         dprint()
+        self.highlightlang = node['lang']
         raise nodes.SkipNode
 
     def visit_section(self, node):
@@ -844,7 +987,7 @@ class DocxTranslator(nodes.NodeVisitor):
 
     def visit_tbody(self, node):
         dprint()
-        self.table.append('sep')
+        pass
 
     def depart_tbody(self, node):
         dprint()
@@ -852,11 +995,18 @@ class DocxTranslator(nodes.NodeVisitor):
 
     def visit_row(self, node):
         dprint()
-        self.table.append([])
+        if self.table_cursor is None :
+            # colspecs are known here, so start the table and stream rows into it
+            colsize = []
+            for x in self.table[0]:
+                colsize.append( int(x)*110 )
+            self.table_cursor = self.docx.begin_table(colsize)
+        self.table_row = []
 
     def depart_row(self, node):
         dprint()
-        pass
+        self.docx.append_table_row(self.table_cursor, self.table_row)
+        self.table_row = None
 
     def visit_entry(self, node):
         dprint()
@@ -869,7 +1019,7 @@ class DocxTranslator(nodes.NodeVisitor):
         dprint()
 	text = self.states.pop()
         #text = '\n'.join('\n'.join(x) for x in self.states.pop())
-        self.table[-1].append(text)
+        self.table_row.append(text)
 
     def visit_table(self, node):
         dprint()
@@ -880,24 +1030,10 @@ class DocxTranslator(nodes.NodeVisitor):
 
     def depart_table(self, node):
         dprint()
-        colsize_chars = self.table[0]
-        colsize = []
-	for i,x in enumerate(colsize_chars):
-          colsize.append( int(x)*110 )
-
-        lines = self.table[1:]
-        fmted_rows = []
-
-        # don't allow paragraphs in table cells for now
-        for line in lines:
-            if line == 'sep':
-                pass
-            else:
-                fmted_rows.append(line)
-
-        self.docx.table(fmted_rows, colsize)
+        # rows are already emitted by depart_row
         self.docx.paragraph("")
         self.table = None
+        self.table_cursor = None
         self.end_state()
 
     def visit_acks(self, node):
@@ -917,11 +1053,30 @@ class DocxTranslator(nodes.NodeVisitor):
         file_path = os.path.join(self.builder.env.srcdir, uri)
         width, height = self.get_image_scaled_width_height(node, file_path)
 
-        self.docx.picture(file_path, '',width, height)
+        self.insert_picture(file_path, width, height)
 
     def depart_image(self, node):
         dprint()
 
+    def insert_picture(self, filename, width, height):
+        '''
+           Insert a picture, which is embedded or linked by 'docx_image_mode'
+        '''
+        link = None
+        if self.builder.config['docx_image_mode'] == 'link' :
+            link = self.get_image_link(filename)
+        self.docx.picture(filename, '', width, height, link=link)
+
+    def get_image_link(self, filename):
+        '''
+           Link to an image file, which is relative to the output directory
+           unless 'docx_image_link_absolute' is set
+        '''
+        filename = os.path.abspath(filename)
+        if self.builder.config['docx_image_link_absolute'] :
+            return urlparse.urljoin('file:', urllib.pathname2url(filename))
+        return urllib.pathname2url(os.path.relpath(filename, os.path.abspath(self.builder.outdir)))
+
     def get_image_width_height(self, node, attr):
         size = None
         if attr in node.attributes:
@@ -961,22 +1116,17 @@ class DocxTranslator(nodes.NodeVisitor):
             scale = 1.0
         return scale
 
-    def get_image_scaled_width_height(self, node, filename):
-        dpi = (72, 72)
+    def get_image_info(self, node, filename):
+        '''
+           Get (size, dpi) of the image, which may be probed by the pre-pass
+        '''
+        info = node.get('docx_image_info')
+        if info is None :
+            info = self.image_info.probe(filename)
+        return info
 
-        if Image is not None :
-            try:
-              imageobj = Image.open(filename, 'r')
-            except:
-              raise RuntimeError('Fail to open image file: %s' % filename)
-
-            dpi = imageobj.info.get('dpi', dpi)
-            # dpi information can be (xdpi, ydpi) or xydpi
-            try: iter(dpi)
-            except: dpi = (dpi, dpi)
-        else:
-            imageobj = None
-            raise RuntimeError('image size not fully specified and PIL not installed')
+    def get_image_scaled_width_height(self, node, filename):
+        size, dpi = self.get_image_info(node, filename)
 
         scale = self.get_image_scale(node)
         width = self.get_image_width_height(node, 'width')
@@ -989,22 +1139,19 @@ class DocxTranslator(nodes.NodeVisitor):
            height = [int(self.docx.styleDocx.document_height * height[0] * 0.00284 ), 'px']
 
         if width is None or height is None:
-            if imageobj is None:
-                raise RuntimeError(
-                    'image size not fully specified and PIL not installed')
             if width is None:
                 if height is None:
-                     width = [imageobj.size[0], 'px']
-                     height = [imageobj.size[1], 'px']
+                     width = [size[0], 'px']
+                     height = [size[1], 'px']
                 else:
-                     scaled_width = imageobj.size[0] * height[0] /imageobj.size[1]
+                     scaled_width = size[0] * height[0] /size[1]
                      width = [scaled_width, 'px']
             else:
                 if height is None:
-                     scaled_height = imageobj.size[1] * width[0] / imageobj.size[0]
+                     scaled_height = size[1] * width[0] / size[0]
                      height = [scaled_height, 'px']
                 else:
-                     height = [imageobj.size[1], 'px']
+                     height = [size[1], 'px']
 
         width[0] *= scale
         height[0] *= scale
@@ -1277,10 +1424,7 @@ class DocxTranslator(nodes.NodeVisitor):
         dprint()
         self.flush_state()
         self.new_state()
-	try:
-	  self.literal_block_lang = node['language']
-	except:
-	  self.literal_block_lang = 'guess'
+	self.literal_block_lang = node.get('language', self.highlightlang)
 
     def depart_literal_block(self, node):
         dprint()
@@ -1291,19 +1435,58 @@ class DocxTranslator(nodes.NodeVisitor):
         highlight_args = node.get('highlight_args', {})
         def warner(msg):
             self.builder.warn(msg, (self.builder.current_docname, node.line))
-        result = []
+        b_level = self.block_level + self.list_level
         for  x in self.states:
-          linenos = 1
           if x :
-            highlighted = self.highlighter.highlight_block(
-                     x[0], self.literal_block_lang, # warn=warner,
-                    linenos=linenos, **highlight_args)
-            result.append([highlighted])
+            if is_streamed_block(x[0], self.builder.config['docx_highlight_stream_size'],
+                                 self.builder.config['docx_highlight_max_lines']) :
+                runs = self.highlighter.iter_runs(self.highlighter.iter_tokens(
+                        x[0], self.literal_block_lang,
+                        max_lines=self.builder.config['docx_highlight_max_lines']),
+                        linenos=1, **highlight_args)
+            else:
+                runs = self.get_highlighted_runs(node, x[0], highlight_args)
+            if self.highlighter.token_styles :
+                runs = self.count_saved_bytes(runs)
+            self.docx.literal_block(runs, block_level=b_level)
 
-        self.states=result
-        self.flush_state(_sty='LiteralBlock')
+        self.states = [[]]
         self.end_state()
 
+    def count_saved_bytes(self, runs):
+        '''
+           Generate runs, and count bytes which they saved by referring
+           token styles while they are consumed, not to break streaming
+        '''
+        for run in runs:
+            self.token_style_saved += self.highlighter.get_saved_bytes(run)
+            yield run
+
+    def get_highlighted_runs(self, node, source, highlight_args, linenos=1):
+        '''
+           Get highlighted runs from the cache, the pre-pass or Pygments
+        '''
+        if self.highlight_cache is not None :
+            key = highlight_cache_key(source, self.literal_block_lang,
+                    self.builder.config.pygments_style,
+                    self.builder.config.trim_doctest_flags, highlight_args, linenos,
+                    self.highlighter.token_styles, self.highlighter.style_ids)
+            data = self.highlight_cache.get(key)
+            if data is not None :
+                return fragment_to_runs(data)
+
+        prepared = node.get('docx_highlighted')
+        if prepared is not None and prepared[0] == source :
+            runs = self.highlighter.format_runs(prepared[1], linenos=linenos, **highlight_args)
+        else:
+            runs = self.highlighter.highlight_runs(
+                    source, self.literal_block_lang, # warn=warner,
+                    linenos=linenos, **highlight_args)
+
+        if self.highlight_cache is not None :
+            self.highlight_cache.put(key, runs_to_fragment(runs))
+        return runs
+
     def visit_doctest_block(self, node):
         dprint()
 
@@ -1533,12 +1716,45 @@ class DocxTranslator(nodes.NodeVisitor):
 
     def visit_graphviz(self, node):
         dprint()
-	fname, filename = graphviz.render_dot(self, node['code'], node['options'],'png')
+        prepared = node.get('docx_graphviz')
+        error = node.get('docx_graphviz_error')
+        if prepared is None and error is None :
+            try:
+                prepared = self.dot_renderer.render(node['code'], node['options'], 'png')
+            except graphviz.GraphvizError, exc:
+                error = unicode(exc)
         self.flush_state()
+        if error is not None :
+            # insert a placeholder instead of the diagram
+            sphinx_logger.warning('dot code %r: %s', node['code'], error, location=node)
+            self.docx.paragraph(u'[%s]' % node.get('alt', 'graphviz diagram'))
+            raise nodes.SkipNode
+        fname, filename = prepared
         width, height = self.get_image_scaled_width_height(node, filename)
-        self.docx.picture(filename, '',width, height)
+        self.insert_picture(filename, width, height)
         raise nodes.SkipNode
 
+    def get_math_latex(self, node):
+        '''
+           LaTeX of a math node, the nodes of sphinx.ext.mathbase keep it in 'latex'
+        '''
+        return node.get('latex') or node.astext()
+
+    def visit_math(self, node):
+        dprint()
+        self.add_text(self.math_converter.convert(self.get_math_latex(node)))
+        raise nodes.SkipNode
+
+    def visit_math_block(self, node):
+        dprint()
+        self.flush_state()
+        omath = self.math_converter.convert(self.get_math_latex(node), display=True)
+        self.docx.math_block(omath, block_level=self.block_level + self.list_level,
+                             number=node.get('number'))
+        raise nodes.SkipNode
+
+    visit_displaymath = visit_math_block
+
     def unknown_visit(self, node):
         dprint()
         print node